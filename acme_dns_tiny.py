@@ -1,13 +1,76 @@
 #!/usr/bin/env python3
-# pylint: disable=multiple-imports
+# pylint: disable=multiple-imports,too-many-lines
 """ACME client to met DNS challenge and receive TLS certificate"""
-import argparse, base64, binascii, configparser, copy, hashlib, json, logging
-import re, sys, subprocess, time
-import requests
-import dns.exception, dns.query, dns.name, dns.resolver, dns.rrset, dns.tsigkeyring, dns.update
+import argparse, base64, binascii, collections, configparser, contextlib, contextvars, copy
+import cProfile, datetime, email.utils, hashlib, importlib, importlib.util, itertools, json
+import logging, os, random, re, sys, socket, subprocess, tempfile, threading, time
+import dns
+
+
+class _LazyModule:  # pylint: disable=too-few-public-methods
+    """Module imported only when one of its attributes is first used: the command line help
+    and the configuration checks start without loading the HTTP, DNS and cryptography modules."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, attribute):
+        return getattr(importlib.import_module(self.name), attribute)
+
+
+def _lazy_import(name):
+    """Return the module, or its lazy replacement if it isn't imported yet, None if it isn't
+    installed."""
+    if name in sys.modules:
+        return sys.modules[name]
+    if importlib.util.find_spec(name.partition(".")[0]) is None:
+        return None
+    module = _LazyModule(name)
+    parent, _, child = name.rpartition(".")
+    if parent == "dns":  # used as dns.<child>, the real module replaces it once imported
+        setattr(dns, child, module)
+    return module
+
+
+asyncio = _lazy_import("asyncio")
+requests = _lazy_import("requests")
+ssl = _lazy_import("ssl")
+for _dns_module in ("asyncbackend", "asyncquery", "asyncresolver", "exception", "flags", "inet",
+                    "message", "name", "rcode", "rdatatype", "rrset", "tsig", "tsigkeyring",
+                    "update"):
+    _lazy_import("dns." + _dns_module)
+# optional: native asynchronous HTTP requests instead of requests calls in worker threads
+httpx = _lazy_import("httpx")
+# optional: sign requests in-process instead of running openssl for each request
+x509 = _lazy_import("cryptography.x509")
+hashes = _lazy_import("cryptography.hazmat.primitives.hashes")
+serialization = _lazy_import("cryptography.hazmat.primitives.serialization")
+ec = _lazy_import("cryptography.hazmat.primitives.asymmetric.ec")
+padding = _lazy_import("cryptography.hazmat.primitives.asymmetric.padding")
+rsa = _lazy_import("cryptography.hazmat.primitives.asymmetric.rsa")
 
 LOGGER = logging.getLogger('acme_dns_tiny')
+BAD_NONCE_RETRIES = 3
+# DER encoded named curve OID -> JWS algorithm, JWK curve and coordinate size of EC account keys
+EC_CURVES = {b"\x2a\x86\x48\xce\x3d\x03\x01\x07": ("ES256", "P-256", 32),
+             b"\x2b\x81\x04\x00\x22": ("ES384", "P-384", 48)}
+# domain key type -> openssl req -newkey options and (RSA key size or EC curve name)
+DOMAIN_KEY_TYPES = {"rsa2048": (["rsa:2048"], 2048), "rsa3072": (["rsa:3072"], 3072),
+                    "rsa4096": (["rsa:4096"], 4096),
+                    "p256": (["ec", "-pkeyopt", "ec_paramgen_curve:P-256"], "secp256r1"),
+                    "p384": (["ec", "-pkeyopt", "ec_paramgen_curve:P-384"], "secp384r1")}
+# settings used when the configuration file doesn't give them
+DEFAULT_CONFIG = {
+    "acmednstiny": {
+        "ACMEDirectory": "https://acme-staging-v02.api.letsencrypt.org/directory",
+        "Language": "en", "Contacts": "", "Timeout": 10,
+        "MaxParallelAuthorizations": 0, "MaxParallelOrders": 4, "SignerBackend": "auto",
+        "DomainKeyType": "rsa2048",
+        "PollInitialDelay": 1, "PollMaxDelay": 10, "PollTimeout": 300},
+    "DNS": {"NameServer": "", "TTL": 10, "Timeout": 10, "PropagationTimeout": 60}}
 LOGGER.addHandler(logging.StreamHandler())
+# metrics of the current run, the asyncio tasks and worker threads of its orders inherit it
+_METRICS = contextvars.ContextVar("acme_dns_tiny_metrics", default=None)
 
 
 def _base64(text):
@@ -17,368 +80,1687 @@ def _base64(text):
 
 def _openssl(command, options, communicate=None):
     """Run openssl command line and raise IOError on non-zero return."""
-    with subprocess.Popen(["openssl", command] + options,
-                          stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                          stderr=subprocess.PIPE) as openssl:
+    with _measure("subprocess"), subprocess.Popen(["openssl", command] + options,
+                                                  stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                                  stderr=subprocess.PIPE) as openssl:
         out, err = openssl.communicate(communicate)
         if openssl.returncode != 0:
             raise IOError("OpenSSL Error: {0}".format(err))
         return out
 
 
-# pylint: disable=too-many-locals,too-many-branches,too-many-statements
-def get_crt(config, log=LOGGER):
-    """Get ACME certificate by resolving DNS challenge."""
-
-    def _get_authoritative_server_ips(zone, resolver):
-        """Get all authoritative server ips for a given zone"""
-        main_name = resolver.resolve(zone, rdtype="SOA", lifetime=dns_timeout)[0].mname
-        nameservers = [ns.target for ns in resolver.resolve(
-            zone, rdtype="NS", lifetime=dns_timeout)]
-        nameservers_ipv4 = []
-        nameservers_ipv6 = []
+def _der_elements(der):
+    """Iterate over the (tag, content) of the DER encoded elements following each other."""
+    offset = 0
+    while offset < len(der):
+        tag, length = der[offset], der[offset + 1]
+        offset = offset + 2
+        if length & 0x80:  # long form: the next bytes hold the length
+            length, offset = (int.from_bytes(der[offset:offset + (length & 0x7f)], "big"),
+                              offset + (length & 0x7f))
+        if offset + length > len(der):
+            raise ValueError("Truncated DER element.")
+        yield tag, der[offset:offset + length]
+        offset = offset + length
+
+
+def load_csr(csr_path):  # pylint: disable=too-many-locals
+    """Read a PEM (or DER) CSR file, return its DER encoding and the domains of its CN and
+    SAN DNS names."""
+    with open(csr_path, "rb") as csr_file:
+        csr = csr_file.read()
+    if csr.lstrip().startswith(b"-----"):
+        pem = re.search(rb"-----BEGIN (?:NEW )?CERTIFICATE REQUEST-----(.+?)-----END", csr,
+                        re.DOTALL)
+        if pem is None:
+            raise ValueError("Unable to find a certificate request in the CSR file.")
+        csr = base64.b64decode(b"".join(pem.group(1).split()))
+    domains = set()
+    try:
+        request_info = next(_der_elements(next(_der_elements(csr))[1]))[1]
+        # CertificationRequestInfo: version, subject, subjectPKInfo, [0] attributes
+        _, (_, subject), _, *attributes = _der_elements(request_info)
+        for _, relative_name in _der_elements(subject):
+            for _, type_and_value in _der_elements(relative_name):
+                (_, oid), (tag, value) = _der_elements(type_and_value)
+                if oid == b"\x55\x04\x03":  # commonName
+                    domains.add(value.decode("utf-16-be" if tag == 0x1e else "utf8"))
+        extensions = []
+        for tag, attributes_set in attributes:
+            for _, attribute in _der_elements(attributes_set) if tag == 0xa0 else ():
+                (_, oid), (_, values) = _der_elements(attribute)
+                if oid == b"\x2a\x86\x48\x86\xf7\x0d\x01\x09\x0e":  # extensionRequest
+                    extensions += [extension for _, sequence in _der_elements(values)
+                                   for _, extension in _der_elements(sequence)]
+        for extension in extensions:
+            # Extension: extnID, critical (optional), extnValue
+            fields = list(_der_elements(extension))
+            if fields[0][1] == b"\x55\x1d\x11":  # subjectAltName, extnValue holds GeneralNames
+                domains.update(name.decode("ascii") for tag, name
+                               in _der_elements(next(_der_elements(fields[-1][1]))[1])
+                               if tag == 0x82)  # dNSName
+    except (StopIteration, IndexError, ValueError, UnicodeDecodeError) as error:
+        raise ValueError("Unable to parse the CSR file: {0}".format(error)) from error
+    return csr, domains
+
+
+def generate_csr(domains, key_type="rsa2048"):
+    """Generate a domain private key and a CSR for the domains, return the PEM key and the DER
+    CSR. Everything stays in memory with cryptography, openssl is run once otherwise."""
+    if key_type not in DOMAIN_KEY_TYPES:
+        raise ValueError("Unknown domain key type {0}, it should be one of: {1}".format(
+            key_type, ", ".join(DOMAIN_KEY_TYPES)))
+    newkey, parameter = DOMAIN_KEY_TYPES[key_type]
+    if serialization is None:
+        with tempfile.TemporaryDirectory() as directory:
+            key_path = os.path.join(directory, "domain.key")
+            csr_der = _openssl("req", ["-new", "-newkey"] + newkey + [
+                "-nodes", "-keyout", key_path, "-subj", "/", "-outform", "DER", "-addext",
+                "subjectAltName=" + ",".join("DNS:" + domain for domain in domains)])
+            with open(key_path, "rb") as key_file:
+                return key_file.read(), csr_der
+    if isinstance(parameter, int):
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=parameter)
+    else:
+        private_key = ec.generate_private_key(getattr(ec, parameter.upper())())
+    csr = x509.CertificateSigningRequestBuilder().subject_name(x509.Name([])).add_extension(
+        x509.SubjectAlternativeName([x509.DNSName(domain) for domain in domains]),
+        critical=False).sign(private_key, hashes.SHA256())
+    return (private_key.private_bytes(serialization.Encoding.PEM,
+                                      serialization.PrivateFormat.PKCS8,
+                                      serialization.NoEncryption()),
+            csr.public_bytes(serialization.Encoding.DER))
+
+
+def write_private_key(key_path, key_pem):
+    """Atomically write a private key file, readable only by its owner."""
+    descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(key_path) or ".",
+                                                  suffix=".tmp")
+    with open(descriptor, "wb") as key_file:
+        key_file.write(key_pem)
+    os.replace(temporary_path, key_path)
+
+
+def _load_state(state_directory, name):
+    """Read a state file cached in the state directory, empty if disabled, unknown or invalid."""
+    if not state_directory:
+        return {}
+    try:
+        with open(os.path.join(state_directory, name + ".json"), encoding="utf-8") as state_file:
+            return json.load(state_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_state(state_directory, name, state):
+    """Atomically write a state file, readable only by its owner, in the state directory."""
+    if not state_directory:
+        return
+    os.makedirs(state_directory, mode=0o700, exist_ok=True)
+    descriptor, temporary_path = tempfile.mkstemp(dir=state_directory, suffix=".tmp")
+    with open(descriptor, "w", encoding="utf-8") as state_file:
+        json.dump(state, state_file)
+    os.replace(temporary_path, os.path.join(state_directory, name + ".json"))
+
+
+def _cache_expiration(headers):
+    """Return the timestamp until which a response can be reused according to HTTP caching."""
+    cache_control = [directive.strip().lower()
+                     for directive in headers.get("Cache-Control", "").split(",")]
+    if "no-store" in cache_control or "no-cache" in cache_control:
+        return 0
+    try:
+        for directive in cache_control:
+            if directive.startswith("max-age="):
+                return time.time() + int(directive[8:]) - int(headers.get("Age", 0))
+        if "Expires" in headers:
+            return email.utils.parsedate_to_datetime(headers["Expires"]).timestamp()
+    except (TypeError, ValueError):
+        pass
+    return 0
+
+
+def _shared(shared, key, factory):
+    """Return the task computing a value once for all the orders sharing the dictionary."""
+    if key not in shared:
+        shared[key] = asyncio.ensure_future(factory())
+    return shared[key]
+
+
+class Metrics:
+    """Count and time the phases of the orders of a run, and their ACME requests, DNS queries
+    and updates, subprocesses and sleeps.
+
+    Times of concurrent orders add up, so a phase can last longer than the whole run."""
+
+    def __init__(self):
+        self.started = time.time()
+        self.phases = {}  # phase name -> {"count": count, "seconds": total duration}
+        self.calls = {}  # acme_request, sign, dns_query, dns_update, subprocess or sleep -> same
+        self.certificates = collections.Counter()  # issued, not_due and failed certificates
+        self._lock = threading.Lock()  # signers record their subprocesses from worker threads
+
+    def count(self, result):
+        """Count a certificate issued, not due for renewal or failed."""
+        with self._lock:
+            self.certificates[result] += 1
+
+    def record(self, section, name, seconds):
+        """Count one phase or call of the given duration."""
+        with self._lock:
+            entry = getattr(self, section).setdefault(name, {"count": 0, "seconds": 0.0})
+            entry["count"] += 1
+            entry["seconds"] += seconds
+
+    def report(self):
+        """Return the run report as a dictionary, ready to be dumped as JSON."""
+        with self._lock:
+            return {"started": self.started, "duration": time.time() - self.started,
+                    "certificates": {result: self.certificates[result]
+                                     for result in ("issued", "not_due", "failed")},
+                    "phases": copy.deepcopy(self.phases), "calls": copy.deepcopy(self.calls)}
+
+    def prometheus(self):
+        """Return the run report in the Prometheus text format (for the node_exporter
+        textfile collector)."""
+        report = self.report()
+        lines = []
+        for name, help_text, samples in (
+                ("last_run_timestamp_seconds", "Start time of the last run.",
+                 [("", report["started"])]),
+                ("last_run_duration_seconds", "Duration of the last run.",
+                 [("", report["duration"])]),
+                ("last_run_certificates", "Certificates of the last run by result.",
+                 [('{{result="{0}"}}'.format(result), count)
+                  for result, count in report["certificates"].items()]),
+                ("last_run_phase_seconds", "Time spent in each phase by the last run.",
+                 [('{{phase="{0}"}}'.format(phase), entry["seconds"])
+                  for phase, entry in sorted(report["phases"].items())]),
+                ("last_run_calls", "Calls (or sleeps) made by the last run.",
+                 [('{{call="{0}"}}'.format(call), entry["count"])
+                  for call, entry in sorted(report["calls"].items())]),
+                ("last_run_call_seconds", "Time spent in calls (or sleeps) by the last run.",
+                 [('{{call="{0}"}}'.format(call), entry["seconds"])
+                  for call, entry in sorted(report["calls"].items())])):
+            lines += ["# HELP acme_dns_tiny_{0} {1}".format(name, help_text),
+                      "# TYPE acme_dns_tiny_{0} gauge".format(name)]
+            lines += ["acme_dns_tiny_{0}{1} {2}".format(name, labels, value)
+                      for labels, value in samples]
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def write(path, text):
+        """Atomically write a report file, so it's never read half written."""
+        descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".",
+                                                      suffix=".tmp")
+        os.fchmod(descriptor, 0o644)
+        with open(descriptor, "w", encoding="utf-8") as report_file:
+            report_file.write(text)
+        os.replace(temporary_path, path)
+
+
+@contextlib.contextmanager
+def _measure(name, section="calls"):
+    """Time a call (or a phase) into the metrics of the current run, if any."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics = _METRICS.get()
+        if metrics is not None:
+            metrics.record(section, name, time.perf_counter() - start)
+
+
+class _PhaseTimer:  # pylint: disable=too-few-public-methods
+    """Time the consecutive phases of an order into the metrics of the current run."""
+
+    def __init__(self):
+        self.name = None
+        self.start = time.perf_counter()
+
+    def enter(self, name=None):
+        """End the current phase, start the named one (if any)."""
+        now = time.perf_counter()
+        metrics = _METRICS.get()
+        if self.name is not None and metrics is not None:
+            metrics.record("phases", self.name, now - self.start)
+        self.name, self.start = name, now
+
+
+def _get_resolver(configure=True):
+    """Create an asynchronous resolver measuring its queries."""
+
+    class _Resolver(dns.asyncresolver.Resolver):
+        async def resolve(self, *args, **kwargs):  # pylint: disable=arguments-differ
+            with _measure("dns_query"):
+                return await super().resolve(*args, **kwargs)
+    return _Resolver(configure=configure)
+
+
+def load_account_key(keypath):
+    """Return the JWS algorithm and the public JWK of a RSA or EC (P-256 or P-384) account key."""
+    if serialization is not None:  # in-process, openssl is run only without cryptography
+        with open(keypath, "rb") as keyfile:
+            public_key = serialization.load_pem_private_key(
+                keyfile.read(), password=None).public_key().public_bytes(
+                    serialization.Encoding.DER, serialization.PublicFormat.SubjectPublicKeyInfo)
+    else:
+        public_key = _openssl("pkey", ["-in", keypath, "-pubout", "-outform", "DER"])
+    # SubjectPublicKeyInfo: algorithm (OID and parameters), public key bit string
+    (_, algorithm), (_, bit_string) = _der_elements(next(_der_elements(public_key))[1])
+    oid, *parameters = [content for _, content in _der_elements(algorithm)]
+    if oid == b"\x2a\x86\x48\x86\xf7\x0d\x01\x01\x01":  # rsaEncryption
+        (_, modulus), (_, exponent) = _der_elements(next(_der_elements(bit_string[1:]))[1])
+        return "RS256", {"e": _base64(exponent.lstrip(b"\0")), "kty": "RSA",
+                         "n": _base64(modulus.lstrip(b"\0"))}
+    if oid == b"\x2a\x86\x48\xce\x3d\x02\x01" and parameters[0] in EC_CURVES:  # ecPublicKey
+        alg, curve, size = EC_CURVES[parameters[0]]
+        point = bit_string[2:]  # skip unused bits count and uncompressed point marker
+        if bit_string[1:2] != b"\x04" or len(point) != 2 * size:
+            raise ValueError("Unsupported account key, its EC public key should be an "
+                             "uncompressed point.")
+        return alg, {"crv": curve, "kty": "EC",
+                     "x": _base64(point[:size]), "y": _base64(point[size:])}
+    raise ValueError("Unsupported account key, it should be a RSA, P-256 or P-384 key.")
+
+
+def _jws_signature(alg, signature):
+    """Convert a DER encoded ECDSA signature to the fixed size r and s values used by JWS."""
+    if not alg.startswith("ES"):
+        return signature
+    size = {"ES256": 32, "ES384": 48}[alg]
+    (_, r_value), (_, s_value) = _der_elements(next(_der_elements(signature))[1])
+    return (int.from_bytes(r_value, "big").to_bytes(size, "big")
+            + int.from_bytes(s_value, "big").to_bytes(size, "big"))
+
+
+def _jws_protected(alg, url, *, nonce=None, jwk=None, kid=None):
+    """Encode the protected header of a JWS signed with the account key given by its jwk or its
+    account identifier (kid)."""
+    protected = {"alg": alg, "nonce": nonce, "url": url, "jwk": jwk, "kid": kid}
+    return _base64(json.dumps({name: value for name, value in protected.items()
+                               if value is not None}).encode("utf8"))
+
+
+def _challenge_rrset(name, ttl, token, thumbprint):
+    """Return the digest of the key authorization of a DNS challenge and the TXT resource set
+    giving it."""
+    keydigest64 = _base64(hashlib.sha256("{0}.{1}".format(token, thumbprint).encode("utf8"))
+                          .digest())
+    return keydigest64, dns.rrset.from_text(name, ttl, "IN", "TXT", '"{0}"'.format(keydigest64))
+
+
+class OpenSSLSigner:  # pylint: disable=too-few-public-methods
+    """Sign data with the account key by running the openssl command line for each signature."""
+    name = "openssl"
+
+    def __init__(self, keypath, alg="RS256"):
+        self.keypath = keypath
+        self.alg = alg
+
+    def sign(self, data):
+        """Return the JWS signature of data."""
+        digest = "-sha384" if self.alg == "ES384" else "-sha256"
+        return _jws_signature(self.alg, _openssl("dgst", [digest, "-sign", self.keypath], data))
+
+
+class CryptographySigner:  # pylint: disable=too-few-public-methods
+    """Sign data in-process with the account key loaded once in memory."""
+    name = "cryptography"
+
+    def __init__(self, keypath, alg="RS256"):
+        self.alg = alg
+        with open(keypath, "rb") as keyfile:
+            self._key = serialization.load_pem_private_key(keyfile.read(), password=None)
+
+    def sign(self, data):
+        """Return the JWS signature of data."""
+        if self.alg == "RS256":
+            return self._key.sign(data, padding.PKCS1v15(), hashes.SHA256())
+        return _jws_signature(self.alg, self._key.sign(data, ec.ECDSA(
+            hashes.SHA384() if self.alg == "ES384" else hashes.SHA256())))
+
+
+def get_signer(keypath, backend="auto", alg=None):
+    """Load the account key with the given signer backend (auto, cryptography or openssl), to
+    sign with the given JWS algorithm (found from the account key if not given)."""
+    if backend == "auto":
+        backend = "openssl" if serialization is None else "cryptography"
+    if backend not in ("cryptography", "openssl"):
+        raise ValueError("Unknown signer backend: {0}".format(backend))
+    if backend == "cryptography" and serialization is None:
+        raise ValueError("The cryptography signer backend needs the cryptography module.")
+    alg = alg or load_account_key(keypath)[0]
+    if backend == "cryptography":
+        return CryptographySigner(keypath, alg)
+    return OpenSSLSigner(keypath, alg)
+
+
+class HTTPClient:  # pylint: disable=too-few-public-methods
+    """Send HTTP requests without blocking the event loop.
+
+    An httpx.AsyncClient session is used natively, a requests session is used in worker threads."""
+
+    def __init__(self, session, timeout=None):
+        self.session = session
+        self.timeout = timeout or (None, None)  # (connect, read) timeouts
+
+    async def request(self, method, url, **kwargs):
+        """Send a request and return its response, None if the server can't be reached."""
+        with _measure("acme_request"):
+            return await self._request(method, url, **kwargs)
+
+    async def _request(self, method, url, **kwargs):
+        if httpx is not None and isinstance(self.session, httpx.AsyncClient):
+            try:
+                return await self.session.request(method, url, timeout=httpx.Timeout(
+                    self.timeout[1], connect=self.timeout[0], pool=None), **kwargs)
+            except httpx.HTTPError:
+                return None
+        try:
+            return await asyncio.to_thread(self.session.request, method, url,
+                                           timeout=self.timeout, **kwargs)
+        except requests.exceptions.RequestException as error:
+            return error.response
+
+
+class NoncePool:
+    """Pool of anti-replay nonces harvested from every ACME server response."""
+
+    def __init__(self, http, new_nonce_url, headers=None, size=10):
+        self.http = http
+        self.new_nonce_url = new_nonce_url
+        self.headers = headers or {}
+        self._nonces = collections.deque(maxlen=size)  # oldest nonces are dropped first
+
+    def harvest(self, response):
+        """Keep the nonce given by a server response, if any."""
+        nonce = response.headers.get("Replay-Nonce")
+        if nonce:
+            self._nonces.append(nonce)
+
+    async def _new_nonce(self):
+        response = await self.http.request("HEAD", self.new_nonce_url, headers=self.headers)
+        if response is None or "Replay-Nonce" not in response.headers:
+            raise RuntimeError("Unable to get a new nonce from ACME server.")
+        return response
+
+    async def prefetch(self, count):
+        """Ask the server for new nonces, all at once, until the pool holds count of them."""
+        missing = min(count, self._nonces.maxlen) - len(self._nonces)
+        for response in await asyncio.gather(*[self._new_nonce() for _ in range(missing)]):
+            self.harvest(response)
+
+    async def get(self):
+        """Hand out the most recent unused nonce, ask a new one to the server if none is left."""
+        if self._nonces:
+            return self._nonces.pop()
+        return (await self._new_nonce()).headers["Replay-Nonce"]
+
+
+class Poller:
+    """Schedule the polls of an ACME resource until a deadline.
+
+    The delay given by the server Retry-After header is used when present, otherwise an
+    exponential backoff with jitter is applied between the initial and maximum delays."""
+
+    def __init__(self, name, initial_delay=1.0, maximum_delay=10.0, timeout=300.0):
+        self.name = name
+        self.initial_delay = initial_delay
+        self.maximum_delay = maximum_delay
+        self.timeout = timeout
+        self.delay = initial_delay
+        self.deadline = time.monotonic() + timeout
+        self.polls = 0
+
+    @staticmethod
+    def retry_after(response):
+        """Return the number of seconds asked by the Retry-After header, None if unusable."""
+        value = response.headers.get("Retry-After", "")
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def next_delay(self, response):
+        """Count a poll and return the delay before the next one, raise ValueError if the
+        deadline would be exceeded."""
+        self.polls += 1
+        delay = self.retry_after(response)
+        if delay is None:
+            delay = random.uniform(self.delay / 2, self.delay)
+            self.delay = min(self.delay * 2, self.maximum_delay)
+        if time.monotonic() + delay > self.deadline:
+            raise ValueError("Timeout while waiting for {0} after {1} polls ({2} seconds)"
+                             .format(self.name, self.polls, self.timeout))
+        return delay
+
+    async def wait(self, response):
+        """Sleep, without blocking the event loop, before the next poll."""
+        delay = self.next_delay(response)
+        with _measure("sleep"):
+            await asyncio.sleep(delay)
+
+
+class ZoneCache:
+    """Cache of zone cuts and of authoritative server IPs, bounded by DNS TTLs."""
+
+    def __init__(self, resolver, timeout=None, state_directory=""):
+        self.resolver = resolver
+        self.timeout = timeout
+        self.state_directory = state_directory
+        state = _load_state(state_directory, "zones")
+        self._zones = state.get("zones", {})  # name -> {"zone": zone, "expires": timestamp}
+        # zone -> {"ips": [ip], "hosts": {name server: [ip]}, "expires": timestamp}
+        self._servers = state.get("servers", {})
+        self._lookups = {}  # running lookups, awaited by all orders asking the same thing
+
+    @staticmethod
+    def _get(entries, key, field):
+        entry = entries.get(key)
+        return entry.get(field) if entry and entry["expires"] > time.time() else None
+
+    def _set(self, entries, key, entry):
+        entries[key] = entry
+        _save_state(self.state_directory, "zones",
+                    {"zones": self._zones, "servers": self._servers})
+
+    async def _lookup(self, key, function, argument):
+        """Run function only once at a time for the same key, all callers get its result."""
+        if key not in self._lookups:
+            self._lookups[key] = asyncio.ensure_future(function(argument))
+            self._lookups[key].add_done_callback(lambda _: self._lookups.pop(key, None))
+        return await self._lookups[key]
+
+    async def zone_for_name(self, name):
+        """Find the name of the zone containing name."""
+        zone = self._get(self._zones, name.to_text(), "zone")
+        if zone is None:
+            zone = await self._lookup(("zone", name.to_text()), self._find_zone, name)
+        return dns.name.from_text(zone)
+
+    async def _find_zone(self, name):
+        zone = (await dns.asyncresolver.zone_for_name(name, resolver=self.resolver)).to_text()
+        soa = await self.resolver.resolve(zone, rdtype="SOA", lifetime=self.timeout)
+        self._set(self._zones, name.to_text(), {"zone": zone, "expires": soa.expiration})
+        return zone
+
+    async def authoritative_server_ips(self, zone):
+        """Get all authoritative server ips for a given zone, main server ips first."""
+        nameservers_ips = self._get(self._servers, zone.to_text(), "ips")
+        if nameservers_ips is None:
+            nameservers_ips = await self._lookup(("servers", zone.to_text()),
+                                                 self._find_servers, zone)
+        return nameservers_ips
+
+    async def authoritative_servers(self, zone):
+        """Get the ips of each authoritative server of a given zone, by server name."""
+        hosts = self._get(self._servers, zone.to_text(), "hosts")
+        if hosts is None:
+            await self._lookup(("servers", zone.to_text()), self._find_servers, zone)
+            hosts = self._servers[zone.to_text()]["hosts"]
+        return hosts
+
+    async def _find_servers(self, zone):
+        soa, ns_answer = await asyncio.gather(
+            self.resolver.resolve(zone, rdtype="SOA", lifetime=self.timeout),
+            self.resolver.resolve(zone, rdtype="NS", lifetime=self.timeout))
+        nameservers = [ns.target for ns in ns_answer]
         # Add the main (aka "master") name server ip to the head of the list
         # (see "Requestor Behavior" section of RFC 2136)
-        if main_name in nameservers:
-            nameservers_ipv6 += [ip.address for ip in resolver.resolve(main_name, rdtype="AAAA",
-                                                                       raise_on_no_answer=False,
-                                                                       lifetime=dns_timeout)]
-            nameservers_ipv4 += [ip.address for ip in resolver.resolve(main_name, rdtype="A",
-                                                                       raise_on_no_answer=False,
-                                                                       lifetime=dns_timeout)]
-        for nameserver in list(filter(lambda ns: ns != main_name, nameservers)):
-            nameservers_ipv6 += [ip.address for ip in resolver.resolve(nameserver, rdtype="AAAA",
-                                                                       raise_on_no_answer=False,
-                                                                       lifetime=dns_timeout)]
-            nameservers_ipv4 += [ip.address for ip in resolver.resolve(nameserver, rdtype="A",
-                                                                       raise_on_no_answer=False,
-                                                                       lifetime=dns_timeout)]
+        if soa[0].mname in nameservers:
+            nameservers.remove(soa[0].mname)
+            nameservers.insert(0, soa[0].mname)
+        # Resolve addresses of all name servers at the same time, IPv6 first
+        answers = await asyncio.gather(*[
+            self.resolver.resolve(nameserver, rdtype=rdtype, raise_on_no_answer=False,
+                                  lifetime=self.timeout)
+            for rdtype in ("AAAA", "A") for nameserver in nameservers])
         nameservers_ips = []
-        for ns_ip in nameservers_ipv6 + nameservers_ipv4:
-            if ns_ip not in nameservers_ips:
-                nameservers_ips.append(ns_ip)
+        hosts = {nameserver.to_text(): [] for nameserver in nameservers}
+        for index, answer in enumerate(answers):
+            for ns_ip in [ip.address for ip in answer]:
+                hosts[nameservers[index % len(nameservers)].to_text()].append(ns_ip)
+                if ns_ip not in nameservers_ips:
+                    nameservers_ips.append(ns_ip)
+        self._set(self._servers, zone.to_text(), {
+            "ips": nameservers_ips, "hosts": hosts,
+            "expires": min([soa.expiration, ns_answer.expiration]
+                           + [answer.expiration for answer in answers if answer.rrset])})
         return nameservers_ips
 
-    def _update_dns(rrset, action, resolver):
-        """Updates DNS resource by adding or deleting resource."""
-        algorithm = dns.name.from_text("{0}".format(config["TSIGKeyring"]["Algorithm"].lower()))
-        dns_zone = dns.resolver.zone_for_name(rrset.name, resolver=resolver)
-        # Prepare dns update message
-        dns_update = dns.update.Update(dns_zone,
-                                       keyring=private_keyring, keyalgorithm=algorithm)
-        if action == "add":
-            dns_update.add(rrset.name, rrset)
-        elif action == "delete":
-            dns_update.delete(rrset.name, rrset)
-        # Send DNS update request to main zone nameservers
-        response = None
-        for nameserver in _get_authoritative_server_ips(dns_zone, resolver):
-            try:
-                response = dns.query.tcp(dns_update, nameserver, timeout=dns_timeout)
-            # pylint: disable=broad-except
-            except Exception as exception:
-                log.debug("Unable to %s DNS resource on dns main server with IP %s, try again "
-                          "with next available dns main server IP. Error detail: %s", action,
-                          nameserver, exception)
-                response = None
-            if response is not None:
-                break
-        if response is None:
-            raise RuntimeError("Unable to {0} DNS resource to {1}".format(action, rrset.name))
-
-    def _send_signed_request(url, payload, extra_headers=None):
-        """Sends signed requests to ACME server."""
-        nonlocal nonce
+
+class DNSConnections:
+    """Persistent TCP connections to the main DNS servers, one by server IP: all the DNS update
+    messages of a client go over them instead of a new connection (and handshake) each.
+
+    Messages to the same server are sent one after another on its connection, a connection
+    closed or broken since its previous message is opened again once."""
+
+    def __init__(self, timeout=None, port=53):
+        self.timeout = timeout
+        self.port = port
+        self._sockets = {}  # nameserver ip -> connected stream socket, free for the next message
+        self._locks = {}  # nameserver ip -> lock held while a message is sent to it
+
+    async def send(self, message, nameserver):
+        """Send the DNS message to the nameserver IP, return its (TSIG verified) response."""
+        lock = self._locks.setdefault(nameserver, asyncio.Lock())
+        async with lock:
+            sock = self._sockets.pop(nameserver, None)
+            if sock is not None:
+                try:
+                    return await self._exchange(message, nameserver, sock)
+                except (EOFError, OSError):
+                    pass  # closed by the server since the previous message, connect again
+            sock = await dns.asyncbackend.get_default_backend().make_socket(
+                dns.inet.af_for_address(nameserver), socket.SOCK_STREAM, 0, None,
+                (nameserver, self.port), self.timeout)
+            return await self._exchange(message, nameserver, sock)
+
+    async def _exchange(self, message, nameserver, sock):
+        try:
+            response = await dns.asyncquery.tcp(message, nameserver, timeout=self.timeout,
+                                                port=self.port, sock=sock)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                await sock.close()
+            raise
+        self._sockets[nameserver] = sock
+        return response
+
+    async def close(self):
+        """Close all the connections."""
+        sockets, self._sockets = list(self._sockets.values()), {}
+        for sock in sockets:
+            with contextlib.suppress(OSError):
+                await sock.close()
+
+
+def _timestamp(date):
+    """Return the timestamp of an UTC datetime, or of a RFC 3339 date and time string."""
+    if isinstance(date, str):  # fractional seconds are dropped, Python < 3.11 can't parse them
+        date = datetime.datetime.fromisoformat(re.sub(r"\.[0-9]+", "",
+                                                      date.replace("Z", "+00:00")))
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return date.timestamp()
+
+
+def _certificate_validity(certificate):
+    """Return validity start and end timestamps of the first certificate of a PEM chain, with
+    its ACME Renewal Information (ARI) identifier, None without authority key identifier."""
+    if serialization is not None:
+        cert = x509.load_pem_x509_certificate(certificate.encode("utf8"))
+        not_before, not_after = [_timestamp(getattr(cert, name + "_utc", None)
+                                            or getattr(cert, name))
+                                 for name in ("not_valid_before", "not_valid_after")]
+        serial = cert.serial_number
+        try:
+            key_identifier = cert.extensions.get_extension_for_class(
+                x509.AuthorityKeyIdentifier).value.key_identifier
+        except x509.ExtensionNotFound:
+            key_identifier = None
+    else:
+        text = _openssl("x509", ["-noout", "-serial", "-startdate", "-enddate",
+                                 "-ext", "authorityKeyIdentifier"],
+                        certificate.encode("utf8")).decode("utf8")
+        not_before, not_after = [_timestamp(datetime.datetime.strptime(
+            re.search(name + r"=(.+)", text).group(1).strip(), "%b %d %H:%M:%S %Y GMT"))
+            for name in ("notBefore", "notAfter")]
+        serial = int(re.search(r"serial=([0-9A-Fa-f]+)", text).group(1), 16)
+        key_identifier = re.search(
+            r"Authority Key Identifier:\s*(?:keyid:)?([0-9A-Fa-f]{2}(?::[0-9A-Fa-f]{2})*)", text)
+        if key_identifier is not None:
+            key_identifier = binascii.unhexlify(key_identifier.group(1).replace(":", ""))
+    if key_identifier is None:
+        return not_before, not_after, None
+    return not_before, not_after, "{0}.{1}".format(
+        _base64(key_identifier), _base64(serial.to_bytes((serial.bit_length() + 8) // 8, "big")))
+
+
+async def _renewal_schedule(certificate, acme_config, http, headers, log=LOGGER):
+    """Choose when to renew a certificate inside the renewal window suggested by the ACME server
+    (ARI), or else inside a window starting when a third of its validity remains.
+
+    The time is picked from a hash of the certificate: it doesn't change between runs and
+    renewals of many certificates are spread over the window."""
+    not_before, not_after, cert_id = await asyncio.to_thread(_certificate_validity, certificate)
+    lifetime = not_after - not_before
+    window = (not_before + lifetime * 2 / 3, not_before + lifetime * 3 / 4)
+    if cert_id is not None and "renewalInfo" in acme_config:
+        response = await http.request("GET", "{0}/{1}".format(
+            acme_config["renewalInfo"].rstrip("/"), cert_id), headers=headers)
+        try:
+            suggested_window = response.json()["suggestedWindow"]
+            window = (_timestamp(suggested_window["start"]), _timestamp(suggested_window["end"]))
+            log.debug("  - ACME server suggests to renew certificate between %s and %s",
+                      suggested_window["start"], suggested_window["end"])
+        except (AttributeError, KeyError, TypeError, ValueError) as error:
+            log.warning("Unable to get renewal information from ACME server, renew when a third "
+                        "of the certificate validity remains: %s: %s", type(error).__name__, error)
+    fraction = int.from_bytes(hashlib.sha256(certificate.encode("utf8")).digest()[:8], "big")
+    return {"time": window[0] + (window[1] - window[0]) * fraction / 2 ** 64,
+            "replaces": cert_id if "renewalInfo" in acme_config else None}
+
+
+def get_http_session(pool_size=10):
+    """Create a keep-alive HTTP session pooling connections to the ACME server."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def _ssl_context():
+    """Create the TLS context of httpx sessions, trusting the CA bundle given to requests by
+    the REQUESTS_CA_BUNDLE or CURL_CA_BUNDLE environment variables, if any."""
+    ca_bundle = os.environ.get("REQUESTS_CA_BUNDLE") or os.environ.get("CURL_CA_BUNDLE")
+    if ca_bundle and os.path.isdir(ca_bundle):
+        return ssl.create_default_context(capath=ca_bundle)
+    if ca_bundle:
+        return ssl.create_default_context(cafile=ca_bundle)
+    return True  # httpx default CA bundle
+
+
+def get_async_http_session(pool_size=10):
+    """Create a keep-alive asynchronous HTTP session, a threaded one if httpx is missing."""
+    if httpx is None:
+        return get_http_session(pool_size)
+    return httpx.AsyncClient(limits=httpx.Limits(max_connections=pool_size,
+                                                 max_keepalive_connections=pool_size),
+                             verify=_ssl_context(), follow_redirects=True)
+
+
+async def _close_http_session(session):
+    if hasattr(session, "aclose"):  # httpx, requests may not be installed
+        await session.aclose()
+    else:
+        session.close()
+
+
+# settings of an order, the other ones configure the ACME client which orders can share
+_ORDER_SETTINGS = {"csrfile", "domains", "domainkeyfile", "domainkeytype", "certificateformat",
+                   "maxparallelauthorizations", "maxparallelorders", "pollinitialdelay",
+                   "pollmaxdelay", "polltimeout", "ttl", "propagationtimeout"}
+
+
+class AcmeClient:  # pylint: disable=too-many-instance-attributes
+    """Long-lived ACME client owning the HTTP session, the signer, the nonce pool, the ACME
+    directory, the account identifier and the DNS helpers, each loaded once on first use.
+
+    A service can keep one client in its event loop for all its orders and account operations.
+    The configuration given sets the account, ACME server and DNS settings, the one given to
+    get_crt sets the settings of its order (CSR or domains, polling and DNS propagation)."""
+
+    def __init__(self, config, log=LOGGER, session=None):
+        self.config = config
+        self.log = log
+        self.owns_session = session is None
+        self.session = session or get_async_http_session(
+            config["acmednstiny"].getint("HTTPPoolSize", 10))
+        read_timeout = config["acmednstiny"].getint("Timeout") or None
+        self.http = HTTPClient(self.session, (
+            config["acmednstiny"].getint("ConnectTimeout", read_timeout or 0) or None,
+            read_timeout))
+        self.headers = {'User-Agent': 'acme-dns-tiny/4.0',
+                        'Accept-Language': config["acmednstiny"]["Language"]}
+        self.directory_url = config["acmednstiny"]["ACMEDirectory"]
+        self.state_directory = config["acmednstiny"].get("StateDirectory", "")
+        self.dns_timeout = config["DNS"].getint("Timeout") or None
+        self.account_keypath = config["acmednstiny"]["AccountKeyFile"]
+        self.kid = None  # account identifier, known once the account is found or registered
+        self.kid_from_cache = False  # the identifier comes from the state directory
+        self.nonces = self.signer = self.resolver = self.zone_cache = None
+        self.dns_connections = DNSConnections(self.dns_timeout)
+        self._keyring = None
+        self._account_state_name, self._account_state = None, {}
+        self._tasks = {}  # name -> task loading a value once for all the calls of the client
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        """Close the DNS connections and the HTTP session, if the client created it."""
+        await self.dns_connections.close()
+        if self.owns_session:
+            await _close_http_session(self.session)
+
+    async def directory(self):
+        """Return the ACME server directory, fetched (or taken from the state directory) once,
+        and start the nonce pool."""
+        return await _shared(self._tasks, "directory", self._load_directory)
+
+    async def _load_directory(self):
+        directory_state_name = "directory-{0}".format(
+            hashlib.sha256(self.directory_url.encode("utf8")).hexdigest())
+        directory_state = _load_state(self.state_directory, directory_state_name)
+        http_response = None
+        if directory_state.get("expires", 0) > time.time():
+            self.log.debug("  - Use cached directory from state directory.")
+            acme_config = directory_state["directory"]
+        else:
+            directory_headers = self.headers | (
+                {"If-None-Match": directory_state["etag"]} if directory_state.get("etag") else {})
+            http_response = await self.http.request("GET", self.directory_url,
+                                                    headers=directory_headers)
+            if http_response is None:
+                raise RuntimeError("Unable to get response from ACME server.")
+            acme_config = (directory_state["directory"] if http_response.status_code == 304
+                           else http_response.json())
+            _save_state(self.state_directory, directory_state_name, {
+                "directory": acme_config, "etag": http_response.headers.get("ETag"),
+                "expires": _cache_expiration(http_response.headers)})
+        self.nonces = NoncePool(self.http, acme_config["newNonce"], self.headers,
+                                max(self.config["acmednstiny"].getint("NoncePoolSize", 10), 1))
+        if http_response is not None:
+            self.nonces.harvest(http_response)
+        return acme_config
+
+    async def dns_helpers(self):
+        """Return the DNS resolver and the cache of the zones it finds, created once."""
+        return await _shared(self._tasks, "dns", self._configure_dns)
+
+    async def _configure_dns(self):
+        nameservers = list(filter(lambda ip: ip != "", self.config["DNS"]["NameServer"]
+                                  .replace(" ", "").split(",")))
+        self.resolver = _get_resolver(configure=not nameservers)
+        if nameservers:
+            self.resolver.nameservers = nameservers
+        # explicitly disable the DNS suffix search list as the ACME server doesn't know it
+        self.resolver.use_search_by_default = False
+        self.zone_cache = ZoneCache(self.resolver, self.dns_timeout, self.state_directory)
+        # That keyring is used to authenticate with the main DNS server, it needs to be safely kept
+        self._keyring = dns.tsigkeyring.from_text({self.config["TSIGKeyring"]["KeyName"]:
+                                                   self.config["TSIGKeyring"]["KeyValue"]})
+        return self.resolver, self.zone_cache
+
+    async def account_key(self):
+        """Load the account key once: its public key (cached in the state directory) and its
+        signer. Return the JWK thumbprint of the key."""
+        await _shared(self._tasks, "account_key", self._load_account_key)
+        return self._account_state["thumbprint"]
+
+    async def _load_account_key(self):
+        self._account_state_name, self._account_state, self.signer = await self._read_account_key(
+            self.account_keypath)
+        self.log.debug("  - Requests will be signed with the %s backend.", self.signer.name)
+
+    async def _read_account_key(self, keypath):
+        """Return the state name, the state (with the public key) and the signer of a key."""
+        with open(keypath, "rb") as account_key_file:
+            state_name = "account-{0}".format(hashlib.sha256(account_key_file.read()).hexdigest())
+        state = _load_state(self.state_directory, state_name)
+        if "jwk" in state:
+            self.log.debug("  - Use cached public key from state directory.")
+        else:
+            alg, jwk = await asyncio.to_thread(load_account_key, keypath)
+            private_jwk = json.dumps(jwk, sort_keys=True, separators=(",", ":"))
+            state = {"alg": alg, "jwk": jwk, "accounts": {}, "thumbprint": _base64(
+                hashlib.sha256(private_jwk.encode("utf8")).digest())}
+            _save_state(self.state_directory, state_name, state)
+        signer = await asyncio.to_thread(get_signer, keypath, self.config["acmednstiny"].get(
+            "SignerBackend", "auto"), state["alg"])
+        return state_name, state, signer
+
+    def _account_request(self):
+        account_request = {"contact": self.config["acmednstiny"]["Contacts"].split(';')}
+        if account_request["contact"] == [""]:
+            del account_request["contact"]
+        return account_request
+
+    def _cache_account(self, kid):
+        """Record (or forget, when None) the account identifier in the account key state."""
+        accounts = self._account_state.setdefault("accounts", {})
+        if kid is None:
+            accounts.pop(self.directory_url, None)
+        else:
+            accounts[self.directory_url] = {
+                "kid": kid, "contact": self._account_request().get("contact", [])}
+        _save_state(self.state_directory, self._account_state_name, self._account_state)
+
+    async def account(self):
+        """Return the account identifier: the one cached in the state directory if its contacts
+        didn't change, otherwise the account is registered (or updated) once."""
+        if self.kid is None:
+            await _shared(self._tasks, "account", self._find_or_register_account)
+        return self.kid
+
+    async def _find_or_register_account(self):
+        await self.account_key()
+        cached_account = self._account_state.get("accounts", {}).get(self.directory_url)
+        if (cached_account is not None and set(cached_account["contact"])
+                == set(self._account_request().get("contact", []))):
+            self.kid, self.kid_from_cache = cached_account["kid"], True
+            self.log.info("Use cached ACME account identifier: '%s'", self.kid)
+        else:
+            await self.register_account()
+
+    async def register_account(self):
+        """Register the account (or find the existing one), update its contacts, return its
+        identifier."""
+        acme_config = await self.directory()
+        self.log.info("Register ACME Account to get the account identifier.")
+        account_request = self._account_request()
+        terms_service = acme_config.get("meta", {}).get("termsOfService", "")
+        if terms_service:
+            account_request["termsOfServiceAgreed"] = True
+            self.log.warning(("Terms of service exist and will be automatically agreed if "
+                              "possible, you should read them: %s"), terms_service)
+
+        http_response, account_info = await self.send_signed_request(acme_config["newAccount"],
+                                                                     account_request)
+        if http_response.status_code == 201:
+            self.kid = http_response.headers['Location']
+            self.log.info("  - Registered a new account: '%s'", self.kid)
+        elif http_response.status_code == 200:
+            self.kid = http_response.headers['Location']
+            self.log.debug("  - Account is already registered: '%s'", self.kid)
+
+            http_response, account_info = await self.send_signed_request(self.kid, "")
+        else:
+            raise ValueError("Error registering account: {0} {1}"
+                             .format(http_response.status_code, account_info))
+
+        self.log.info("Update contact information if needed.")
+        if ("contact" in account_request
+                and set(account_request["contact"]) != set(account_info.get("contact", ""))):
+            http_response, result = await self.send_signed_request(self.kid, account_request)
+            if http_response.status_code == 200:
+                self.log.debug("  - Account updated with latest contact informations.")
+            else:
+                raise ValueError("Error registering updates for the account: {0} {1}"
+                                 .format(http_response.status_code, result))
+        self.kid_from_cache = False
+        self._cache_account(self.kid)
+        return self.kid
+
+    async def find_account(self):
+        """Return the identifier of the existing account of the key, without registering it."""
+        acme_config = await self.directory()
+        self.log.info("Ask to the ACME server the account identifier to complete the private "
+                      "signature.")
+        http_response, result = await self.send_signed_request(acme_config["newAccount"],
+                                                               {"onlyReturnExisting": True})
+        if http_response.status_code != 200:
+            raise ValueError("Error looking or account URL: {0} {1}"
+                             .format(http_response.status_code, result))
+        self.kid = http_response.headers["Location"]
+        return self.kid
+
+    async def send_signed_request(self, url, payload, extra_headers=None):
+        """Sends signed requests to ACME server, retrying at once on badNonce errors.
+
+        Requests to the newAccount URL are signed with the account JWK, the other ones with the
+        account identifier. Return the response and its JSON content (empty if there's none)."""
+        acme_config = await self.directory()
+        await self.account_key()
         if payload == "":  # on POST-as-GET, final payload has to be just empty string
             payload64 = ""
         else:
             payload64 = _base64(json.dumps(payload).encode("utf8"))
-        protected = copy.deepcopy(private_acme_signature)
-        protected["nonce"] = nonce or requests.get(acme_config["newNonce"], headers=adt_headers,
-                                                   timeout=acme_timeout).headers['Replay-Nonce']
-        del nonce
-        protected["url"] = url
-        if url == acme_config["newAccount"]:
-            if "kid" in protected:
-                del protected["kid"]
-        else:
-            del protected["jwk"]
-        protected64 = _base64(json.dumps(protected).encode("utf8"))
-        signature = _openssl("dgst", ["-sha256", "-sign", config["acmednstiny"]["AccountKeyFile"]],
-                             "{0}.{1}".format(protected64, payload64).encode("utf8"))
-        jose = {
-            "protected": protected64, "payload": payload64, "signature": _base64(signature)
-        }
         jose_headers = {
-            'Content-Type': 'application/jose+json'} | adt_headers | (extra_headers or {})
-        try:
-            response = requests.post(url, json=jose, headers=jose_headers, timeout=acme_timeout)
-        except requests.exceptions.RequestException as error:
-            response = error.response
-        if response:
-            nonce = response.headers['Replay-Nonce']
+            'Content-Type': 'application/jose+json'} | self.headers | (extra_headers or {})
+        attempt = 0
+        while True:
+            if url == acme_config["newAccount"]:
+                key = {"jwk": self._account_state["jwk"]}
+            else:
+                key = {"kid": self.kid}
+            protected64 = _jws_protected(self._account_state["alg"], url,
+                                         nonce=await self.nonces.get(), **key)
+            with _measure("sign"):
+                signature = await asyncio.to_thread(
+                    self.signer.sign, "{0}.{1}".format(protected64, payload64).encode("utf8"))
+            jose = {
+                "protected": protected64, "payload": payload64, "signature": _base64(signature)
+            }
+            response = await self.http.request("POST", url, json=jose, headers=jose_headers)
+            if response is None:
+                raise RuntimeError("Unable to get response from ACME server.")
+            self.nonces.harvest(response)
             try:
-                return response, response.json()
+                result = response.json()
             except ValueError:  # if body is empty or not JSON formatted
-                return response, json.loads("{}")
-        else:
-            raise RuntimeError("Unable to get response from ACME server.")
-
-    # main code
-    acme_timeout = config["acmednstiny"].getint("Timeout") or None
-    dns_timeout = config["DNS"].getint("Timeout") or None
-    adt_headers = {'User-Agent': 'acme-dns-tiny/4.0',
-                   'Accept-Language': config["acmednstiny"]["Language"]}
-    nonce = None
-
-    log.info("Find domains to validate from the Certificate Signing Request (CSR) file.")
-    csr = _openssl("req", ["-in", config["acmednstiny"]["CSRFile"],
-                           "-noout", "-text"]).decode("utf8")
-    domains = set()
-    common_name = re.search(r"Subject:.*?\s+?CN\s*?=\s*?([^\s,;/]+)", csr)
-    if common_name is not None:
-        domains.add(common_name.group(1))
-    subject_alt_names = re.search(
-        r"X509v3 Subject Alternative Name: (?:critical)?\s+([^\r\n]+)\r?\n",
-        csr, re.MULTILINE)
-    if subject_alt_names is not None:
-        for san in subject_alt_names.group(1).split(", "):
-            if san.startswith("DNS:"):
-                domains.add(san[4:])
-    if len(domains) == 0:  # pylint: disable=len-as-condition
-        raise ValueError("Didn't find any domain to validate in the provided CSR.")
+                result = {}
+            if (response.status_code == 400 and attempt < BAD_NONCE_RETRIES
+                    and result.get("type") == "urn:ietf:params:acme:error:badNonce"):
+                self.log.debug("  - Nonce rejected by ACME server, send again request to %s",
+                               url)
+                attempt = attempt + 1
+                continue
+            return response, result
 
-    log.info("Configure DNS client tools.")
-    # That keyring is used to authenticate with the main DNS server, it needs to be safely kept
-    private_keyring = dns.tsigkeyring.from_text({config["TSIGKeyring"]["KeyName"]:
-                                                 config["TSIGKeyring"]["KeyValue"]})
-    # Prepare DNS resolver
-    resolver = dns.resolver.Resolver(configure=True)
-    nameservers = list(filter(lambda ip: ip != "", config["DNS"]["NameServer"]
-                              .replace(" ", "").split(",")))
-    if nameservers:
-        resolver = dns.resolver.Resolver(configure=False)
-        resolver.nameservers = nameservers
-
-    # explicitly disable the DNS suffix search list as the ACME server doesn't know it
-    resolver.use_search_by_default = False
-
-    log.info("Get private signature from account key.")
-    accountkey = _openssl("rsa", ["-in", config["acmednstiny"]["AccountKeyFile"],
-                                  "-noout", "-text"])
-    signature_search = re.search(r"modulus:\s+?00:([a-f0-9\:\s]+?)\r?\npublicExponent: ([0-9]+)",
-                                 accountkey.decode("utf8"), re.MULTILINE)
-    if signature_search is None:
-        raise ValueError("Unable to retrieve private signature.")
-    pub_hex, pub_exp = signature_search.groups()
-    pub_exp = "{0:x}".format(int(pub_exp))
-    pub_exp = "0{0}".format(pub_exp) if len(pub_exp) % 2 else pub_exp
-    # That signature is used to authenticate with the ACME server, it needs to be safely kept
-    private_acme_signature = {
-        "alg": "RS256",
-        "jwk": {
-            "e": _base64(binascii.unhexlify(pub_exp.encode("utf-8"))),
-            "kty": "RSA",
-            "n": _base64(binascii.unhexlify(re.sub(r"(\s|:)", "", pub_hex).encode("utf-8"))),
-        },
-    }
-    private_jwk = json.dumps(private_acme_signature["jwk"], sort_keys=True, separators=(",", ":"))
-    jwk_thumbprint = _base64(hashlib.sha256(private_jwk.encode("utf8")).digest())
-
-    log.info("Fetch ACME server configuration from its directory URL.")
-    acme_config = requests.get(config["acmednstiny"]["ACMEDirectory"], headers=adt_headers,
-                               timeout=acme_timeout).json()
-    terms_service = acme_config.get("meta", {}).get("termsOfService", "")
-
-    log.info("Register ACME Account to get the account identifier.")
-    account_request = {}
-    if terms_service:
-        account_request["termsOfServiceAgreed"] = True
-        log.warning(("Terms of service exist and will be automatically agreed if possible, "
-                     "you should read them: %s"), terms_service)
-    account_request["contact"] = config["acmednstiny"]["Contacts"].split(';')
-    if account_request["contact"] == [""]:
-        del account_request["contact"]
-
-    http_response, account_info = _send_signed_request(acme_config["newAccount"], account_request)
-    if http_response.status_code == 201:
-        private_acme_signature["kid"] = http_response.headers['Location']
-        log.info("  - Registered a new account: '%s'", private_acme_signature["kid"])
-    elif http_response.status_code == 200:
-        private_acme_signature["kid"] = http_response.headers['Location']
-        log.debug("  - Account is already registered: '%s'", private_acme_signature["kid"])
-
-        http_response, account_info = _send_signed_request(private_acme_signature["kid"], "")
-    else:
-        raise ValueError("Error registering account: {0} {1}"
-                         .format(http_response.status_code, account_info))
-
-    log.info("Update contact information if needed.")
-    if ("contact" in account_request
-            and set(account_request["contact"]) != set(account_info.get("contact", ""))):
-        http_response, result = _send_signed_request(private_acme_signature["kid"],
-                                                     account_request)
-        if http_response.status_code == 200:
-            log.debug("  - Account updated with latest contact informations.")
-        else:
-            raise ValueError("Error registering updates for the account: {0} {1}"
+    async def update_dns(self, rrsets, action):
+        """Updates DNS resources by adding or deleting them, with one message by zone. All zones
+        are updated even if one fails, then an error names the resources not updated."""
+        _, zone_cache = await self.dns_helpers()
+        algorithm = dns.name.from_text("{0}".format(
+            self.config["TSIGKeyring"]["Algorithm"].lower()))
+        zones_rrsets = {}
+        for rrset in rrsets:
+            zones_rrsets.setdefault(await zone_cache.zone_for_name(rrset.name), []).append(rrset)
+        failed = set()
+        for dns_zone, zone_rrsets in zones_rrsets.items():
+            # Prepare one dns update message holding all resources of the zone
+            dns_update = dns.update.Update(dns_zone,
+                                           keyring=self._keyring, keyalgorithm=algorithm)
+            for rrset in zone_rrsets:
+                if action == "add":
+                    dns_update.add(rrset.name, rrset)
+                elif action == "delete":
+                    dns_update.delete(rrset.name, rrset)
+            # Send DNS update request to main zone nameservers
+            response = await self._send_dns_update(
+                dns_update, await zone_cache.authoritative_server_ips(dns_zone), action)
+            if response is None:
+                failed.update(rrset.name.to_text() for rrset in zone_rrsets)
+        if failed:
+            raise RuntimeError("Unable to {0} DNS resource to {1}".format(
+                action, ", ".join(sorted(failed))))
+
+    async def _send_dns_update(self, dns_update, nameservers, action):
+        """Send the DNS update to the nameserver IPs with staggered parallel attempts (in the
+        style of RFC 8305), IPv6 and IPv4 addresses interleaved: the next attempt starts after
+        UpdateAttemptDelay seconds, or as soon as the previous one fails. Return the first
+        successful response and cancel the other attempts, None if all of them fail."""
+        delay = self.config["DNS"].getfloat("UpdateAttemptDelay", 0.25)
+        pairs = itertools.zip_longest([ip for ip in nameservers if ":" in ip],
+                                      [ip for ip in nameservers if ":" not in ip])
+        waiting = [nameserver for pair in pairs for nameserver in pair if nameserver is not None]
+        attempts = {}  # running attempt -> nameserver ip
+        try:
+            while waiting or attempts:
+                if waiting:
+                    nameserver = waiting.pop(0)
+                    attempts[asyncio.ensure_future(
+                        self._dns_update_attempt(dns_update, nameserver))] = nameserver
+                done, _ = await asyncio.wait(attempts, timeout=delay if waiting else None,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                for attempt in done:
+                    nameserver = attempts.pop(attempt)
+                    if attempt.exception() is None:
+                        return attempt.result()
+                    self.log.debug("Unable to %s DNS resources on dns main server with IP %s, "
+                                   "try again with other dns main server IPs. Error detail: %s",
+                                   action, nameserver, attempt.exception())
+            return None
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
+            await asyncio.gather(*attempts, return_exceptions=True)
+
+    async def _dns_update_attempt(self, dns_update, nameserver):
+        # each attempt signs its own copy: the TSIG MAC of a message is kept in it to verify
+        # the response, concurrent attempts would overwrite it
+        dns_update = copy.deepcopy(dns_update)
+        with _measure("dns_update"):
+            response = await self.dns_connections.send(dns_update, nameserver)
+        if response.rcode() != dns.rcode.NOERROR:
+            raise ValueError("DNS server answered {0}".format(
+                dns.rcode.to_text(response.rcode())))
+        return response
+
+    async def rollover(self, new_keypath):
+        """Roll over the account key to the new one, which then signs the client requests."""
+        acme_config = await self.directory()
+        await self.account_key()
+        kid = self.kid or await self.find_account()
+        self.log.info("Rolling over account keys.")
+        state_name, state, signer = await self._read_account_key(new_keypath)
+        # The signature by the new key covers the account URL and the old key,
+        # signifying a request by the new key holder to take over the account from
+        # the old key holder.
+        protected64 = _jws_protected(state["alg"], acme_config["keyChange"], jwk=state["jwk"])
+        payload64 = _base64(json.dumps({"account": kid, "oldKey": self._account_state["jwk"]})
+                            .encode("utf8"))
+        with _measure("sign"):
+            signature = await asyncio.to_thread(
+                signer.sign, "{0}.{1}".format(protected64, payload64).encode("utf8"))
+        # The signature by the old key covers this request and its signature, and
+        # indicates the old key holder's assent to the roll-over request.
+        http_response, result = await self.send_signed_request(acme_config["keyChange"], {
+            "protected": protected64, "payload": payload64, "signature": _base64(signature)})
+        if http_response.status_code != 200:
+            raise ValueError("Error rolling over account key: {0} {1}"
                              .format(http_response.status_code, result))
+        self._cache_account(None)
+        self.account_keypath = new_keypath
+        self._account_state_name, self._account_state, self.signer = state_name, state, signer
+        self._cache_account(kid)
+        self.log.info("Keys rolled over.")
 
-    # new order
-    log.info("Request to the ACME server an order to validate domains.")
-    new_order = {"identifiers": [{"type": "dns", "value": domain} for domain in domains]}
-    http_response, order = _send_signed_request(acme_config["newOrder"], new_order)
-    if http_response.status_code == 201:
-        order_location = http_response.headers['Location']
-        log.debug("  - Order received: %s", order_location)
-        if order["status"] != "pending" and order["status"] != "ready":
-            raise ValueError("Order status is neither pending neither ready, we can't use it: {0}"
-                             .format(order))
-    elif (http_response.status_code == 403
-          and order["type"] == "urn:ietf:params:acme:error:userActionRequired"):
-        raise ValueError(("Order creation failed ({0}). Read Terms of Service ({1}), then follow "
-                          "your CA instructions: {2}")
-                         .format(order["detail"],
-                                 http_response.headers['Link'], order["instance"]))
-    else:
-        raise ValueError("Error getting new Order: {0} {1}"
-                         .format(http_response.status_code, order))
-
-    # complete each authorization challenge
-    for authz in order["authorizations"]:
-        if order["status"] == "ready":
-            log.info("No challenge to process: order is already ready.")
-            break
-
-        log.info("Process challenge for authorization: %s", authz)
-        # get new challenge
-        http_response, authorization = _send_signed_request(authz, "")
+    async def deactivate(self):
+        """Deactivate the account: the ACME server then refuses all its requests."""
+        kid = self.kid or await self.find_account()
+        self.log.info("Deactivating the account.")
+        http_response, result = await self.send_signed_request(kid, {"status": "deactivated"})
         if http_response.status_code != 200:
-            raise ValueError("Error fetching challenges: {0} {1}"
-                             .format(http_response.status_code, authorization))
-        domain = authorization["identifier"]["value"]
-
-        if authorization["status"] == "valid":
-            log.info("Skip authorization for domain %s: this is already validated", domain)
-            continue
-        if authorization["status"] != "pending":
-            raise ValueError("Authorization for the domain {0} can't be validated: "
-                             "the authorization is {1}.".format(domain, authorization["status"]))
-
-        challenges = [c for c in authorization["challenges"] if c["type"] == "dns-01"]
-        if not challenges:
-            raise ValueError("Unable to find a DNS challenge to resolve for domain {0}"
-                             .format(domain))
-        log.info("Install DNS TXT resource for domain: %s", domain)
-        challenge = challenges[0]
-        keyauthorization = challenge["token"] + "." + jwk_thumbprint
-        keydigest64 = _base64(hashlib.sha256(keyauthorization.encode("utf8")).digest())
-        dnsrr_domain = "_acme-challenge.{0}.".format(domain)
-        try:  # a CNAME resource can be used for advanced TSIG configuration
-            # Note: the CNAME target has to be of "non-CNAME" type (recursion isn't managed)
-            dnsrr_domain = [response.to_text() for response
-                            in resolver.resolve(dnsrr_domain, rdtype="CNAME",
-                                                lifetime=dns_timeout)][0]
-            log.info("  - A CNAME resource has been found for this domain, will install TXT on %s",
-                     dnsrr_domain)
-        except dns.exception.DNSException as dnsexception:
-            log.debug(("  - No CNAME resource has been found for this domain (%s), will "
-                       "install TXT directly on %s"), type(dnsexception).__name__, dnsrr_domain)
-        dnsrr_set = dns.rrset.from_text(dnsrr_domain, config["DNS"].getint("TTL"),
-                                        "IN", "TXT", '"{0}"'.format(keydigest64))
+            raise ValueError("Error while deactivating the account key: {0} {1}"
+                             .format(http_response.status_code, result))
+        self._cache_account(None)
+        self.kid = None
+        self._tasks.pop("account", None)
+        self.log.info("The account has been deactivated.")
+
+    async def _run_concurrently(self, function, items, max_workers):
+        """Run function for each authorization URL concurrently, report errors together."""
+        semaphore = asyncio.Semaphore(max_workers or max(len(items), 1))
+
+        async def _run(authz):
+            async with semaphore:
+                return await function(authz)
+        results = await asyncio.gather(*[_run(authz) for authz in items], return_exceptions=True)
+        errors = [(authz, result) for authz, result in zip(items, results)
+                  if isinstance(result, BaseException)]
+        for authz, error in errors:
+            self.log.error("Authorization %s failed: %s", authz, error)
+        if len(errors) == 1:
+            raise errors[0][1]
+        if errors:
+            raise ValueError("Unable to validate {0} authorizations: {1}".format(
+                len(errors), "; ".join("{0}: {1}".format(authz, error)
+                                       for authz, error in errors)))
+        return results
+
+    def _has_challenge_value(self, pending, rrsets, source):
+        """Tell if the TXT resources found on source hold the value of the authorization."""
+        for rrset in rrsets:
+            if rrset.rdtype == dns.rdatatype.TXT:
+                for rdata in rrset:
+                    self.log.debug("  - Found value %s for %s on %s", rdata.to_text(),
+                                   pending["domain"], source)
+                    if rdata.to_text() == '"{0}"'.format(pending["keydigest64"]):
+                        return True
+        return False
+
+    async def _check_challenge_resource(self, pending, nameserver):
+        """Check the TXT resource of one authorization is served by one authoritative server
+        ip, over UDP then over TCP if UDP fails or is truncated. Return None if the server
+        can't be reached."""
+        query = dns.message.make_query(pending["dnsrr_domain"], "TXT")
+        response = None
         try:
-            _update_dns(dnsrr_set, "add", resolver)
-        except dns.exception.DNSException as exception:
-            raise ValueError("Error updating DNS records: {0} : {1}"
-                             .format(type(exception).__name__, str(exception))) from exception
-
-        log.info("Wait for 1 TTL (%s seconds) to ensure DNS cache is cleared.",
-                 config["DNS"].getint("TTL"))
-        time.sleep(config["DNS"].getint("TTL"))
-        challenge_verified = False
-        number_check_fail = 1
-        while challenge_verified is False:
+            with _measure("dns_query"):
+                response = await dns.asyncquery.udp(query, nameserver, timeout=self.dns_timeout)
+        except (dns.exception.DNSException, OSError) as exception:
+            self.log.debug("  - DNS error while checking challenge of %s on %s over UDP, try "
+                           "TCP: %s : %s", pending["domain"], nameserver,
+                           type(exception).__name__, exception)
+        if response is None or response.flags & dns.flags.TC:
             try:
-                log.info(('Self test (try: %s): Check resource with value "%s" exits on '
-                          'nameservers: %s'), number_check_fail, keydigest64,
-                         resolver.nameservers)
-                for response in resolver.resolve(dnsrr_domain, rdtype="TXT",
-                                                 lifetime=dns_timeout).rrset:
-                    log.debug("  - Found value %s", response.to_text())
-                    challenge_verified = (challenge_verified
-                                          or response.to_text() == '"{0}"'.format(keydigest64))
-            except dns.exception.DNSException as dnsexception:
-                log.info(
-                    "  - Will retry as a DNS error occurred while checking challenge: %s : %s",
-                    type(dnsexception).__name__, dnsexception)
-            finally:
-                if challenge_verified is False:
-                    if number_check_fail >= 10:
-                        raise ValueError("Error checking challenge, value not found: {0}"
-                                         .format(keydigest64))
-                    number_check_fail = number_check_fail + 1
-                    time.sleep(config["DNS"].getint("TTL"))
-
-        log.info("Asking ACME server to validate challenge.")
-        http_response, result = _send_signed_request(challenge["url"], {})
-        if http_response.status_code != 200:
-            raise ValueError("Error triggering challenge: {0} {1}"
-                             .format(http_response.status_code, result))
+                with _measure("dns_query"):
+                    response = await dns.asyncquery.tcp(query, nameserver,
+                                                        timeout=self.dns_timeout)
+            except (dns.exception.DNSException, OSError) as exception:
+                self.log.debug("  - DNS error while checking challenge of %s on %s: %s : %s",
+                               pending["domain"], nameserver, type(exception).__name__,
+                               exception)
+                return None
+        return self._has_challenge_value(pending, response.answer, nameserver)
+
+    async def _check_challenge_with_resolver(self, pending):
+        """Check the TXT resource of one authorization is served by the DNS resolver, used
+        when no ip of an authoritative server can be reached."""
+        try:
+            answer = await self.resolver.resolve(pending["dnsrr_domain"], "TXT",
+                                                 lifetime=self.dns_timeout)
+        except dns.exception.DNSException as exception:
+            self.log.debug("  - DNS error while checking challenge of %s with the resolver: "
+                           "%s : %s", pending["domain"], type(exception).__name__, exception)
+            return False
+        return self._has_challenge_value(pending, [answer.rrset], "the resolver")
+
+    async def _check_challenge_server(self, pending, nameserver_ips):
+        """Check the TXT resource of one authorization is served by one authoritative server,
+        asking all its ips at once and using the first answer. Ips which can't be reached are
+        removed from nameserver_ips, return None if none of them can be reached."""
+        queries = {asyncio.ensure_future(self._check_challenge_resource(pending, nameserver)):
+                   nameserver for nameserver in nameserver_ips}
+        try:
+            while queries:
+                done, _ = await asyncio.wait(queries, return_when=asyncio.FIRST_COMPLETED)
+                answers = set()
+                for query in done:
+                    if query.result() is None:
+                        nameserver_ips.remove(queries[query])
+                    answers.add(query.result())
+                    del queries[query]
+                if answers - {None}:
+                    return True in answers
+            return None
+        finally:
+            for query in queries:
+                query.cancel()
+            await asyncio.gather(*queries, return_exceptions=True)
+
+    async def _self_test_challenges(self, pendings, timeout):
+        """Poll all authoritative servers until they serve every TXT resource, on at least one
+        ip of each server. When a server can't be reached on any ip, the DNS resolver has to
+        serve the resource instead."""
+        unverified = []
+        for pending in pendings.values():
+            hosts = await self.zone_cache.authoritative_servers(
+                await self.zone_cache.zone_for_name(pending["dnsrr_set"].name))
+            unverified.extend((pending, list(ips)) for ips in hosts.values() if ips)
+        deadline = time.monotonic() + timeout
+        delay = 0.1
+        number_check = 1
+        while unverified:
+            self.log.info("Self test (try: %s): Check %s resources exist on authoritative "
+                          "servers", number_check, len(unverified))
+            verifications = await asyncio.gather(*[
+                self._check_challenge_with_resolver(pending) if ips is None
+                else self._check_challenge_server(pending, ips) for pending, ips in unverified])
+            checks, unverified = unverified, []
+            for (pending, ips), verified in zip(checks, verifications):
+                if verified is None:
+                    self.log.warning("Unable to reach an authoritative server to check challenge "
+                                     "of %s, check it with the DNS resolver.", pending["domain"])
+                    ips = None
+                if not verified and (pending, ips) not in unverified:
+                    unverified.append((pending, ips))
+            if unverified:
+                if time.monotonic() + delay > deadline:
+                    raise ValueError("Error checking challenge, value not found: {0}".format(
+                        ", ".join(sorted({pending["keydigest64"]
+                                          for pending, _ in unverified}))))
+                number_check = number_check + 1
+                with _measure("sleep"):
+                    await asyncio.sleep(delay)
+                delay = min(delay * 2, 5)
+
+    async def _new_order(self, domains, renewal):
+        """Ask the ACME server a new order to validate domains, return its URL and content."""
+        acme_config = await self.directory()
+        self.log.info("Request to the ACME server an order to validate domains.")
+        new_order = {"identifiers": [{"type": "dns", "value": domain} for domain in domains]}
+        if renewal is not None and renewal["replaces"]:
+            new_order["replaces"] = renewal["replaces"]
+        http_response, order = await self.send_signed_request(acme_config["newOrder"], new_order)
+        if (http_response.status_code in (400, 409) and "replaces" in new_order
+                and order.get("type") == "urn:ietf:params:acme:error:alreadyReplaced"):
+            self.log.info("  - Certificate has already been replaced by another order, order "
+                          "again.")
+            del new_order["replaces"]
+            http_response, order = await self.send_signed_request(acme_config["newOrder"],
+                                                                  new_order)
+        if (self.kid_from_cache and http_response.status_code in (400, 401, 403)
+                and order.get("type") in ("urn:ietf:params:acme:error:accountDoesNotExist",
+                                          "urn:ietf:params:acme:error:unauthorized")):
+            self.log.info("  - Cached account has been rejected (%s), register it again.",
+                          order.get("detail"))
+            await self.register_account()
+            http_response, order = await self.send_signed_request(acme_config["newOrder"],
+                                                                  new_order)
+        if http_response.status_code == 201:
+            order_location = http_response.headers['Location']
+            self.log.debug("  - Order received: %s", order_location)
+            if order["status"] != "pending" and order["status"] != "ready":
+                raise ValueError("Order status is neither pending neither ready, we can't use "
+                                 "it: {0}".format(order))
+        elif (http_response.status_code == 403
+              and order["type"] == "urn:ietf:params:acme:error:userActionRequired"):
+            raise ValueError(("Order creation failed ({0}). Read Terms of Service ({1}), then "
+                              "follow your CA instructions: {2}")
+                             .format(order["detail"],
+                                     http_response.headers['Link'], order["instance"]))
+        else:
+            raise ValueError("Error getting new Order: {0} {1}"
+                             .format(http_response.status_code, order))
+        return order_location, order
+
+    async def get_crt(self, config=None, certificate=None):
+        """Get ACME certificate by resolving DNS challenge, with the order settings of the
+        configuration given (the client one by default).
+
+        When the current certificate chain is given, a new one is ordered only if it's due for
+        renewal, None is returned otherwise. The phases of the order, and its calls, are
+        recorded in the metrics of the current run, if any."""
+        phases = _PhaseTimer()
+        result = "failed"
         try:
+            certificate_chain = await self._order_certificate(config or self.config, certificate,
+                                                              phases)
+            result = "issued" if certificate_chain is not None else "not_due"
+            return certificate_chain
+        finally:
+            phases.enter()
+            if _METRICS.get() is not None:
+                _METRICS.get().count(result)
+
+    # pylint: disable=too-many-locals,too-many-branches,too-many-statements
+    async def _order_certificate(self, config, certificate, phases):
+        """Order a certificate, see get_crt, and time its phases."""
+        log = self.log
+
+        def _get_poller(name):
+            """Create a poller configured from the polling settings."""
+            return Poller(name, config["acmednstiny"].getfloat("PollInitialDelay"),
+                          config["acmednstiny"].getfloat("PollMaxDelay"),
+                          config["acmednstiny"].getfloat("PollTimeout"))
+
+        phases.enter("directory")
+        log.info("Fetch ACME server configuration from its directory URL.")
+        acme_config = await self.directory()
+
+        renewal = None
+        if certificate is not None:
+            phases.enter("renewal_information")
+            renewal = await _renewal_schedule(certificate, acme_config, self.http, self.headers,
+                                              log)
+            if renewal["time"] > time.time():
+                log.info("Certificate is not due for renewal before %s.",
+                         email.utils.formatdate(renewal["time"], usegmt=True))
+                return None
+            log.info("Certificate is due for renewal since %s.",
+                     email.utils.formatdate(renewal["time"], usegmt=True))
+
+        phases.enter("csr")
+        domain_key = None
+        if config.has_option("acmednstiny", "Domains"):
+            log.info("Generate the domain key and the Certificate Signing Request (CSR).")
+            domains = set(filter(None, config["acmednstiny"]["Domains"].replace(" ", "")
+                                 .split(",")))
+            domain_key, csr_der = await asyncio.to_thread(
+                generate_csr, sorted(domains), config["acmednstiny"]["DomainKeyType"])
+        else:
+            log.info("Find domains to validate from the Certificate Signing Request (CSR) file.")
+            csr_der, domains = load_csr(config["acmednstiny"]["CSRFile"])
+        if len(domains) == 0:  # pylint: disable=len-as-condition
+            raise ValueError("Didn't find any domain to validate in the provided CSR.")
+
+        phases.enter("account")
+        log.info("Configure DNS client tools.")
+        resolver, zone_cache = await self.dns_helpers()
+        log.info("Get private signature from account key.")
+        jwk_thumbprint = await self.account_key()
+        await self.account()
+
+        phases.enter("order")
+        # The order journal lets a new run resume the order when a previous one failed part-way
+        csr_digest = hashlib.sha256(csr_der).hexdigest()
+        order_state_name = "order-{0}".format(hashlib.sha256(json.dumps(
+            [self._account_state_name, self.directory_url, sorted(domains)]).encode("utf8"))
+            .hexdigest())
+        order_state = _load_state(self.state_directory, order_state_name)
+        order = None
+        if order_state.get("expires", 0) > time.time():
+            order_location = order_state["order"]
+            http_response, order = await self.send_signed_request(order_location, "")
+            # a certificate issued (or being issued) for another CSR can't be reused
+            if (http_response.status_code == 200 and (
+                    order.get("status") in ("pending", "ready")
+                    or (order.get("status") in ("processing", "valid")
+                        and order_state["csr"] == csr_digest))):
+                log.info("Resume the order %s found in the journal, its status is %s.",
+                         order_location, order["status"])
+            else:
+                log.info("  - Order %s found in the journal can't be resumed (%s), order again.",
+                         order_location, order.get("status", http_response.status_code))
+                order = None
+        if order is None:
+            order_location, order = await self._new_order(domains, renewal)
+            order_state = {
+                "order": order_location, "csr": csr_digest,
+                "expires": (_timestamp(order["expires"]) if "expires" in order
+                            else time.time() + 86400),
+                "authorizations": {authz: "pending" for authz in order["authorizations"]}}
+            _save_state(self.state_directory, order_state_name, order_state)
+
+        def _journal_authorization(authz, status):
+            """Record the status of an authorization in the order journal."""
+            order_state["authorizations"][authz] = status
+            _save_state(self.state_directory, order_state_name, order_state)
+
+        async def _prepare_authorization(authz):
+            """Fetch one authorization and build the TXT resource answering its DNS challenge."""
+            if order_state["authorizations"].get(authz) == "valid":
+                log.info("Skip authorization %s: the journal records it's already validated",
+                         authz)
+                return None
+            log.info("Process challenge for authorization: %s", authz)
+            # get new challenge
+            http_response, authorization = await self.send_signed_request(authz, "")
+            if http_response.status_code != 200:
+                raise ValueError("Error fetching challenges: {0} {1}"
+                                 .format(http_response.status_code, authorization))
+            domain = authorization["identifier"]["value"]
+
+            if authorization["status"] == "valid":
+                log.info("Skip authorization for domain %s: this is already validated", domain)
+                _journal_authorization(authz, "valid")
+                return None
+            if authorization["status"] != "pending":
+                raise ValueError("Authorization for the domain {0} can't be validated: the "
+                                 "authorization is {1}.".format(domain, authorization["status"]))
+
+            challenges = [c for c in authorization["challenges"] if c["type"] == "dns-01"]
+            if not challenges:
+                raise ValueError("Unable to find a DNS challenge to resolve for domain {0}"
+                                 .format(domain))
+            challenge = challenges[0]
+            dnsrr_domain = "_acme-challenge.{0}.".format(domain)
+            try:  # a CNAME resource can be used for advanced TSIG configuration
+                # Note: the CNAME target has to be of "non-CNAME" type (recursion isn't managed)
+                dnsrr_domain = [response.to_text() for response
+                                in await resolver.resolve(dnsrr_domain, rdtype="CNAME",
+                                                          lifetime=self.dns_timeout)][0]
+                log.info("  - A CNAME resource has been found for %s, will install TXT on %s",
+                         domain, dnsrr_domain)
+            except dns.exception.DNSException as dnsexception:
+                log.debug(("  - No CNAME resource has been found for %s (%s), will "
+                           "install TXT directly on %s"), domain, type(dnsexception).__name__,
+                          dnsrr_domain)
+            keydigest64, dnsrr_set = _challenge_rrset(dnsrr_domain, config["DNS"].getint("TTL"),
+                                                      challenge["token"], jwk_thumbprint)
+            return {"url": authz, "domain": domain, "challenge": challenge,
+                    "keydigest64": keydigest64, "dnsrr_domain": dnsrr_domain,
+                    "dnsrr_set": dnsrr_set}
+
+        async def _validate_challenge(authz):
+            """Ask the ACME server to validate the challenge of one authorization and wait for
+            it."""
+            pending = pendings[authz]
+            domain = pending["domain"]
+            log.info("Asking ACME server to validate challenge for domain: %s", domain)
+            http_response, result = await self.send_signed_request(pending["challenge"]["url"],
+                                                                   {})
+            if http_response.status_code != 200:
+                raise ValueError("Error triggering challenge: {0} {1}"
+                                 .format(http_response.status_code, result))
+            poller = _get_poller("challenge of {0}".format(domain))
             while True:
-                http_response, challenge_status = _send_signed_request(challenge["url"], "")
+                await poller.wait(http_response)
+                http_response, challenge_status = await self.send_signed_request(
+                    pending["challenge"]["url"], "")
                 if http_response.status_code != 200:
                     raise ValueError("Error during challenge validation: {0} {1}".format(
                         http_response.status_code, challenge_status))
-                if challenge_status["status"] == "pending":
-                    time.sleep(2)
-                elif challenge_status["status"] == "valid":
+                if challenge_status["status"] == "valid":
                     log.info("ACME has verified challenge for domain: %s", domain)
+                    _journal_authorization(authz, "valid")
+                    log.debug("  - Challenge of %s polled %s times", domain, poller.polls)
                     break
-                else:
+                if challenge_status["status"] not in ("pending", "processing"):
                     raise ValueError("Challenge for domain {0} did not pass: {1}".format(
                         domain, challenge_status))
-        finally:
-            _update_dns(dnsrr_set, "delete", resolver)
 
-    log.info("Request to finalize the order (all challenges have been completed)")
-    csr_der = _base64(_openssl("req", ["-in", config["acmednstiny"]["CSRFile"],
-                                       "-outform", "DER"]))
-    http_response, result = _send_signed_request(order["finalize"], {"csr": csr_der})
-    if http_response.status_code != 200:
-        raise ValueError("Error while sending the CSR: {0} {1}"
-                         .format(http_response.status_code, result))
+        # complete all authorization challenges concurrently
+        max_workers = config["acmednstiny"].getint("MaxParallelAuthorizations") or None
+        pendings = {}  # authorization URL -> DNS challenge to resolve
+        if order["status"] != "pending":
+            log.info("No challenge to process: order is already %s.", order["status"])
+        else:
+            phases.enter("authorizations")
+            pendings.update({pending["url"]: pending for pending
+                             in await self._run_concurrently(_prepare_authorization,
+                                                             order["authorizations"], max_workers)
+                             if pending is not None})
+            dnsrr_sets = [pending["dnsrr_set"] for pending in pendings.values()]
+            if pendings:
+                phases.enter("zones")
+                # zones and their servers are found (or taken from the cache) before the updates
+                await asyncio.gather(*[zone_cache.authoritative_server_ips(
+                    await zone_cache.zone_for_name(dnsrr_set.name)) for dnsrr_set in dnsrr_sets])
+                phases.enter("dns_update")
+                log.info("Install DNS TXT resources for domains: %s",
+                         ", ".join(pending["domain"] for pending in pendings.values()))
+                try:
+                    # added in the try block: the resources of the zones updated before a
+                    # failing one are deleted too (deleting absent resources does nothing)
+                    try:
+                        await self.update_dns(dnsrr_sets, "add")
+                    except dns.exception.DNSException as exception:
+                        raise ValueError("Error updating DNS records: {0} : {1}".format(
+                            type(exception).__name__, str(exception))) from exception
+                    phases.enter("propagation")
+                    # nonces for challenge requests are fetched while waiting for DNS propagation
+                    await asyncio.gather(self._self_test_challenges(
+                        pendings, config["DNS"].getfloat("PropagationTimeout")),
+                        self.nonces.prefetch(len(pendings)))
+                    phases.enter("challenges")
+                    await self._run_concurrently(_validate_challenge, list(pendings), max_workers)
+                except BaseException:
+                    phases.enter("dns_cleanup")
+                    try:
+                        await self.update_dns(dnsrr_sets, "delete")
+                    except (RuntimeError, dns.exception.DNSException) as exception:
+                        # keep the error which stopped the order
+                        log.warning("Unable to delete DNS TXT resources: %s", exception)
+                    raise
+                phases.enter("dns_cleanup")
+                await self.update_dns(dnsrr_sets, "delete")
 
-    while True:
-        http_response, order = _send_signed_request(order_location, "")
+        phases.enter("finalize")
+        if order["status"] in ("pending", "ready"):
+            log.info("Request to finalize the order (all challenges have been completed)")
+            http_response, order = await self.send_signed_request(order["finalize"],
+                                                                  {"csr": _base64(csr_der)})
+            if http_response.status_code != 200:
+                raise ValueError("Error while sending the CSR: {0} {1}"
+                                 .format(http_response.status_code, order))
 
-        if order["status"] == "processing":
-            try:
-                time.sleep(float(http_response.headers["Retry-After"]))
-            except (OverflowError, ValueError, TypeError):
-                time.sleep(2)
-        elif order["status"] == "valid":
-            log.info("Order finalized!")
-            break
-        else:
+        poller = _get_poller("order {0}".format(order_location))
+        while order["status"] == "processing":
+            await poller.wait(http_response)
+            http_response, order = await self.send_signed_request(order_location, "")
+        if order["status"] != "valid":
             raise ValueError("Finalizing order {0} got errors: {1}".format(
                 order_location, order))
+        log.info("Order finalized!")
+        log.debug("  - Order polled %s times after finalization", poller.polls)
+
+        phases.enter("certificate")
+        http_response, result = await self.send_signed_request(
+            order["certificate"], "",
+            {'Accept': config["acmednstiny"].get("CertificateFormat",
+                                                 'application/pem-certificate-chain')})
+        if http_response.status_code != 200:
+            raise ValueError("Finalizing order {0} got errors: {1}"
+                             .format(http_response.status_code, result))
+
+        if 'link' in http_response.headers:
+            log.info("  - Certificate links given by server: %s", http_response.headers['link'])
+
+        log.info("Certificate signed and chain received: %s", order["certificate"])
+        if domain_key is not None:
+            # written only now, so the previous key keeps matching the previous certificate
+            write_private_key(config["acmednstiny"]["DomainKeyFile"], domain_key)
+            log.info("Domain private key written to %s", config["acmednstiny"]["DomainKeyFile"])
+        _save_state(self.state_directory, order_state_name, {})  # the order is done, forget it
+        return http_response.text
+
+
+def _shared_client(shared, config, log, session):
+    """Return the ACME client of the orders sharing the dictionary and the client settings."""
+    key = ("client",) + tuple((section, option, value) for section in config.sections()
+                              for option, value in config.items(section, raw=True)
+                              if option not in _ORDER_SETTINGS)
+    if key not in shared:
+        shared[key] = AcmeClient(config, log, session)
+    return shared[key]
+
+
+def get_crt(config, log=LOGGER, session=None, metrics=None):
+    """Get ACME certificate by resolving DNS challenge, blocking until it's issued.
+
+    A requests session (see get_http_session) can be given to reuse its connections for many
+    certificates. Each call runs its own event loop, so an httpx.AsyncClient can't be reused
+    between calls: use get_crts, or an AcmeClient in one event loop, to share it."""
+    if httpx is not None and isinstance(session, httpx.AsyncClient):
+        raise ValueError("get_crt can't reuse an httpx.AsyncClient session between its event "
+                         "loops, give a requests session or use get_crts or an AcmeClient.")
+    return asyncio.run(async_get_crt(config, log, session, metrics=metrics))
+
+
+# pylint: disable=too-many-arguments
+async def async_get_crt(config, log=LOGGER, session=None, shared=None, certificate=None, *,
+                        metrics=None):
+    """Get ACME certificate by resolving DNS challenge, many orders can share one event loop.
+
+    The HTTP session (httpx.AsyncClient or requests.Session) can be given to reuse its
+    connections for many certificates, and the shared dictionary to reuse ACME clients (their
+    signers, nonces, ACME accounts and DNS caches) between orders of the same event loop.
+    When the current certificate chain is given, a new one is ordered only if it's due for
+    renewal, None is returned otherwise.
+    The phases of the order, and its calls, are recorded in the Metrics given (or in the ones
+    of the batch of orders)."""
+    if metrics is not None:
+        _METRICS.set(metrics)
+    if session is None or shared is None:  # a client of its own, closed after the order
+        async with AcmeClient(config, log, session) as client:
+            return await client.get_crt(config, certificate)
+    return await _shared_client(shared, config, log, session).get_crt(config, certificate)
+
+
+async def async_get_crts(configs, log=LOGGER, session=None, certificates=None, metrics=None):
+    """Get many ACME certificates concurrently with one HTTP session, sharing ACME clients (their
+    signers, nonces, ACME accounts and DNS caches), at most MaxParallelOrders (of the first
+    config) at once.
+
+    Current certificate chains can be given (None for missing ones) to order only the ones due
+    for renewal. Return for each config its certificate chain, None if it isn't due for
+    renewal, or the exception which stopped its order."""
+    if metrics is not None:
+        _METRICS.set(metrics)
+    if session is None:
+        new_session = get_async_http_session(configs[0]["acmednstiny"].getint("HTTPPoolSize", 10))
+        try:
+            return await async_get_crts(configs, log, new_session, certificates)
+        finally:
+            await _close_http_session(new_session)
+    shared = {}
+    semaphore = asyncio.Semaphore(configs[0]["acmednstiny"].getint("MaxParallelOrders", 4)
+                                  or max(len(configs), 1))
+
+    async def _get_crt(config, certificate):
+        async with semaphore:
+            return await async_get_crt(config, log, session, shared, certificate)
+    try:
+        return await asyncio.gather(*[_get_crt(config, certificate) for config, certificate
+                                      in zip(configs, certificates or [None] * len(configs))],
+                                    return_exceptions=True)
+    finally:
+        for client in shared.values():
+            await client.close()
+
+
+def get_crts(configs, log=LOGGER, session=None, certificates=None, metrics=None):
+    """Get many ACME certificates in one process, blocking until all orders are finished."""
+    return asyncio.run(async_get_crts(configs, log, session, certificates, metrics))
 
-    http_response, result = _send_signed_request(
-        order["certificate"], "",
-        {'Accept': config["acmednstiny"].get("CertificateFormat",
-                                             'application/pem-certificate-chain')})
-    if http_response.status_code != 200:
-        raise ValueError("Finalizing order {0} got errors: {1}"
-                         .format(http_response.status_code, result))
 
-    if 'link' in http_response.headers:
-        log.info("  - Certificate links given by server: %s", http_response.headers['link'])
+def _write_profile(profiler, path, metrics, log):
+    """Write the profiler statistics, log the number of openssl runs, HTTP requests and DNS
+    messages counted by the metrics."""
+    profiler.dump_stats(path)
+    calls = metrics.report()["calls"]
+    log.info("Profile written to %s: %s openssl runs, %s HTTP requests, %s DNS messages.", path,
+             calls.get("subprocess", {}).get("count", 0),
+             calls.get("acme_request", {}).get("count", 0),
+             sum(calls.get(call, {}).get("count", 0) for call in ("dns_query", "dns_update")))
 
-    log.info("Certificate signed and chain received: %s", order["certificate"])
-    return http_response.text
 
+def run_profiled(path, log, function, *args, **kwargs):
+    """Run function with cProfile, counting its calls in new metrics, then write its statistics
+    to path and log its number of openssl runs, HTTP requests and DNS messages."""
+    metrics = Metrics()
+    context = contextvars.copy_context()
+    context.run(_METRICS.set, metrics)
+    profiler = cProfile.Profile()
+    try:
+        return context.run(profiler.runcall, function, *args, **kwargs)
+    finally:
+        _write_profile(profiler, path, metrics, log)
+
+
+def _read_config(configfile, csrfile=None, domains=None, domain_key=None):
+    """Read a configuration file over the default settings, check the required ones."""
+    config = configparser.ConfigParser()
+    config.read_dict(DEFAULT_CONFIG)
+    config.read(configfile)
+
+    if csrfile:
+        config.set("acmednstiny", "csrfile", csrfile)
+        config.remove_option("acmednstiny", "domains")
+    if domains:
+        config.set("acmednstiny", "domains", domains)
+        config.remove_option("acmednstiny", "csrfile")
+    if domain_key:
+        config.set("acmednstiny", "domainkeyfile", domain_key)
 
+    options = set(config.options("acmednstiny"))
+    if (set(["accountkeyfile", "acmedirectory"]) - options
+            or ("csrfile" not in options and set(["domains", "domainkeyfile"]) - options)
+            or set(["keyname", "keyvalue", "algorithm"]) - set(config.options("TSIGKeyring"))):
+        raise ValueError("Some required settings are missing.")
+    return config
+
+
+def account_config(accountkeypath, acme_directory, timeout=10):
+    """Return the configuration of an AcmeClient for account operations only (no order): the
+    default settings with the account key, the ACME server and its requests timeout."""
+    config = configparser.ConfigParser()
+    config.read_dict(DEFAULT_CONFIG)
+    config.read_dict({"acmednstiny": {"AccountKeyFile": accountkeypath,
+                                      "ACMEDirectory": acme_directory, "Timeout": timeout or 0}})
+    return config
+
+
+def check_config(config):
+    """Check a configuration without network access: its numbers, TSIG keyring, account key
+    and CSR (or domains to generate one for). Return the domains, raise ValueError (or OSError
+    for unreadable files) on the first problem found."""
+    for section, options in (("acmednstiny", ("Timeout", "ConnectTimeout", "HTTPPoolSize",
+                                              "NoncePoolSize", "MaxParallelAuthorizations",
+                                              "MaxParallelOrders", "PollInitialDelay",
+                                              "PollMaxDelay", "PollTimeout")),
+                             ("DNS", ("TTL", "Timeout", "PropagationTimeout",
+                                      "UpdateAttemptDelay"))):
+        for option in options:
+            try:
+                config[section].getfloat(option)
+            except ValueError as error:
+                raise ValueError("The {0} setting isn't a number: {1}".format(
+                    option, error)) from error
+    try:
+        if dns.name.from_text(config["TSIGKeyring"]["Algorithm"].lower()) not in (
+                dns.tsig.HMAC_MD5, dns.tsig.HMAC_SHA1, dns.tsig.HMAC_SHA224,
+                dns.tsig.HMAC_SHA256, dns.tsig.HMAC_SHA384, dns.tsig.HMAC_SHA512):
+            raise ValueError("unknown algorithm {0}".format(config["TSIGKeyring"]["Algorithm"]))
+        dns.tsigkeyring.from_text({config["TSIGKeyring"]["KeyName"]:
+                                   config["TSIGKeyring"]["KeyValue"]})
+    except (dns.exception.DNSException, ValueError) as error:  # with invalid base64 values
+        raise ValueError("The TSIG keyring is invalid: {0}: {1}".format(
+            type(error).__name__, error)) from error
+    alg, _ = load_account_key(config["acmednstiny"]["AccountKeyFile"])
+    get_signer(config["acmednstiny"]["AccountKeyFile"],
+               config["acmednstiny"].get("SignerBackend", "auto"), alg)
+    if config.has_option("acmednstiny", "Domains"):
+        domains = set(filter(None, config["acmednstiny"]["Domains"].replace(" ", "").split(",")))
+        if config["acmednstiny"]["DomainKeyType"] not in DOMAIN_KEY_TYPES:
+            raise ValueError("Unknown domain key type: {0}".format(
+                config["acmednstiny"]["DomainKeyType"]))
+        if not os.path.isdir(os.path.dirname(config["acmednstiny"]["DomainKeyFile"]) or "."):
+            raise ValueError("The directory of the domain key file doesn't exist: {0}".format(
+                config["acmednstiny"]["DomainKeyFile"]))
+    else:
+        _, domains = load_csr(config["acmednstiny"]["CSRFile"])
+    if len(domains) == 0:  # pylint: disable=len-as-condition
+        raise ValueError("Didn't find any domain to validate in the provided CSR.")
+    return domains
+
+
+# pylint: disable=too-many-locals,too-many-branches,too-many-statements
 def main(argv):
     """Parse arguments and get certificate."""
     parser = argparse.ArgumentParser(
@@ -390,6 +1772,13 @@ so PLEASE READ THROUGH IT (it won't take too long, it's a one-file script) !
 Example: requests certificate chain and store it in chain.crt
   python3 acme_dns_tiny.py ./example.ini > chain.crt
 
+Example: generates the domain.key private key and requests a certificate chain for its domains
+  python3 acme_dns_tiny.py --domains example.org,www.example.org --domain-key domain.key \
+    --domain-key-type p256 ./example.ini > chain.crt
+
+Example: requests a certificate chain for each CSR file of the csr directory
+  python3 acme_dns_tiny.py --csr-directory ./csr --output-directory ./crt ./example.ini
+
 See example.ini file to configure correctly this script."""
     )
     parser.add_argument("--quiet", action="store_const", const=logging.ERROR,
@@ -399,27 +1788,130 @@ See example.ini file to configure correctly this script."""
     parser.add_argument("--csr",
                         help="specifies CSR file path to use instead of the CSRFile option \
 from the configuration file.")
-    parser.add_argument("configfile", help="path to your configuration file")
+    parser.add_argument("--domains",
+                        help="comma separated domains to get a certificate for, instead of the \
+CSRFile option: the domain key and its CSR are generated in memory.")
+    parser.add_argument("--domain-key",
+                        help="with --domains: path where the generated domain private key is \
+written, instead of the DomainKeyFile option.")
+    parser.add_argument("--domain-key-type", choices=sorted(DOMAIN_KEY_TYPES),
+                        help="with --domains: type of the generated domain private key, \
+instead of the DomainKeyType option (default: rsa2048).")
+    parser.add_argument("--csr-directory",
+                        help="batch mode: get a certificate for each *.csr file of this \
+directory, instead of the CSRFile option from the configuration file.")
+    parser.add_argument("--output-directory",
+                        help="batch mode: write each certificate chain in this directory \
+(default: next to its CSR file), named as its CSR file with the .crt extension.")
+    parser.add_argument("--renew", action="store_true",
+                        help="batch mode: get only certificates missing from the output \
+directory or due for renewal, as suggested by the ACME server if it supports renewal information.")
+    parser.add_argument("--report",
+                        help="write a JSON report of the run to this file: the time spent in \
+each phase of the orders, the number and time of ACME requests, DNS queries and updates, \
+subprocesses and sleeps.")
+    parser.add_argument("--prometheus",
+                        help="write the report of the run to this file in the Prometheus text \
+format, to be read by the node_exporter textfile collector (name it with the .prom extension).")
+    parser.add_argument("--profile",
+                        help="profile the run with cProfile and write its statistics to this \
+file (read them with python3 -m pstats), then log the number of openssl runs, HTTP requests and \
+DNS messages. Work done in worker threads (openssl signatures, HTTP requests without httpx) is \
+counted, but not profiled.")
+    parser.add_argument("--check-config", action="store_true",
+                        help="only check the configuration files, without network access: their \
+settings, TSIG keyring, account key and CSR file (or domains). Exit with an error if one is \
+invalid.")
+    parser.add_argument("configfile", nargs="+",
+                        help="path to your configuration file (batch mode if many are given)")
     args = parser.parse_args(argv)
 
-    config = configparser.ConfigParser()
-    config.read_dict({
-        "acmednstiny": {
-            "ACMEDirectory": "https://acme-staging-v02.api.letsencrypt.org/directory",
-            "Language": "en", "Contacts": "", "Timeout": 10},
-        "DNS": {"NameServer": "", "TTL": 10, "Timeout": 10}})
-    config.read(args.configfile)
-
-    if args.csr:
-        config.set("acmednstiny", "csrfile", args.csr)
+    if len(args.configfile) > 1 and (args.csr or args.csr_directory or args.domains):
+        parser.error("--csr, --csr-directory and --domains need exactly one configuration file")
+    if args.domains and (args.csr or args.csr_directory):
+        parser.error("--domains can't be used with --csr or --csr-directory")
+    if args.csr_directory:
+        csrfiles = sorted(os.path.join(args.csr_directory, name)
+                          for name in os.listdir(args.csr_directory) if name.endswith(".csr"))
+        config_arguments = [(args.configfile[0], csrfile) for csrfile in csrfiles]
+    else:
+        config_arguments = [(configfile, args.csr, args.domains, args.domain_key)
+                            for configfile in args.configfile]
 
-    if (set(["accountkeyfile", "csrfile", "acmedirectory"]) - set(config.options("acmednstiny"))
-            or set(["keyname", "keyvalue", "algorithm"]) - set(config.options("TSIGKeyring"))):
-        raise ValueError("Some required settings are missing.")
+    def _get_config(arguments):
+        config = _read_config(*arguments)
+        if args.domain_key_type:
+            config.set("acmednstiny", "DomainKeyType", args.domain_key_type)
+        return config
 
     LOGGER.setLevel(args.verbose or args.quiet or logging.INFO)
-    signed_crt = get_crt(config, LOGGER)
-    sys.stdout.write(signed_crt)
+    if args.check_config:
+        failures = 0
+        for arguments in config_arguments:
+            name = " with ".join(filter(None, arguments[:2]))
+            try:
+                domains = check_config(_get_config(arguments))
+            except (OSError, ValueError, configparser.Error) as error:
+                failures = failures + 1
+                LOGGER.error("Configuration %s is invalid: %s", name, error)
+                continue
+            LOGGER.info("Configuration %s is valid, for domains: %s", name,
+                        ", ".join(sorted(domains)))
+        if failures:
+            raise ValueError("{0} of {1} configurations are invalid.".format(
+                failures, len(config_arguments)))
+        return
+    configs = [_get_config(arguments) for arguments in config_arguments]
+
+    metrics = Metrics()
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        if len(configs) == 1 and not args.csr_directory and not args.renew:
+            signed_crt = get_crt(configs[0], LOGGER, metrics=metrics)
+            sys.stdout.write(signed_crt)
+            return
+
+        # certificate chains are named as their CSR file, or as their generated domain key file
+        request_files = [config["acmednstiny"].get("CSRFile")
+                         or config["acmednstiny"]["DomainKeyFile"] for config in configs]
+        outputs = [os.path.join(args.output_directory or os.path.dirname(request_file),
+                                os.path.splitext(os.path.basename(request_file))[0] + ".crt")
+                   for request_file in request_files]
+        if len(set(outputs)) != len(outputs):
+            raise ValueError("Some CSR files would write their certificate chain to the same "
+                             "file.")
+        certificates = [None] * len(configs)
+        if args.renew:
+            for index, output in enumerate(outputs):
+                if os.path.exists(output):
+                    with open(output, encoding="utf-8") as certificate_file:
+                        certificates[index] = certificate_file.read()
+        failures = 0
+        results = get_crts(configs, LOGGER, certificates=certificates, metrics=metrics)
+        for request_file, output, result in zip(request_files, outputs, results):
+            if result is None:
+                LOGGER.info("Certificate chain %s is not due for renewal", output)
+                continue
+            if isinstance(result, BaseException):
+                failures = failures + 1
+                LOGGER.error("Failed to get certificate for %s: %s", request_file, result)
+                continue
+            with open(output, "w", encoding="utf-8") as output_file:
+                output_file.write(result)
+            LOGGER.info("Certificate chain for %s written to %s", request_file, output)
+        if failures:
+            raise ValueError("Unable to get {0} of {1} certificates.".format(failures,
+                                                                             len(configs)))
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            _write_profile(profiler, args.profile, metrics, LOGGER)
+        if args.report:
+            Metrics.write(args.report, json.dumps(metrics.report(), indent=2) + "\n")
+        if args.prometheus:
+            Metrics.write(args.prometheus, metrics.prometheus())
 
 
 if __name__ == "__main__":  # pragma: no cover
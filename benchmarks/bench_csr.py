@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""Compare how many CSR files per second are loaded with openssl and with the in-process parser"""
+import sys
+import os
+import re
+import argparse
+import shutil
+import subprocess
+import tempfile
+import time
+import acme_dns_tiny
+
+
+def load_csr_with_openssl(csr_path):
+    """Load a CSR as acme-dns-tiny 4.0 did: parse the openssl text dump, then get the DER."""
+    # pylint: disable=protected-access
+    csr = acme_dns_tiny._openssl("req", ["-in", csr_path, "-noout", "-text"]).decode("utf8")
+    domains = set()
+    common_name = re.search(r"Subject:.*?\s+?CN\s*?=\s*?([^\s,;/]+)", csr)
+    if common_name is not None:
+        domains.add(common_name.group(1))
+    subject_alt_names = re.search(
+        r"X509v3 Subject Alternative Name: (?:critical)?\s+([^\r\n]+)\r?\n",
+        csr, re.MULTILINE)
+    if subject_alt_names is not None:
+        for san in subject_alt_names.group(1).split(", "):
+            if san.startswith("DNS:"):
+                domains.add(san[4:])
+    return acme_dns_tiny._openssl("req", ["-in", csr_path, "-outform", "DER"]), domains
+
+
+def bench_loader(loader, csr_paths, duration):
+    """Load the CSR corpus again and again during duration seconds, return CSR per second."""
+    loaded = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        for csr_path in csr_paths:
+            loader(csr_path)
+        loaded += len(csr_paths)
+    return loaded / (time.perf_counter() - start)
+
+
+def generate_corpus(directory, count, sans):
+    """Generate count CSR files with sans DNS names each, return their paths."""
+    csr_paths = []
+    for index in range(count):
+        csr_path = os.path.join(directory, "{0}.csr".format(index))
+        names = ",".join("DNS:host{0}.domain{1}.example.org".format(name, index)
+                         for name in range(sans))
+        subprocess.run(["openssl", "req", "-new", "-newkey", "rsa:2048", "-nodes",
+                        "-keyout", os.devnull, "-subj", "/CN=domain{0}.example.org".format(index),
+                        "-addext", "subjectAltName={0}".format(names), "-out", csr_path],
+                       check=True, capture_output=True)
+        csr_paths.append(csr_path)
+    return csr_paths
+
+
+def main(argv):
+    """Run the CSR loading benchmark with both loaders."""
+    parser = argparse.ArgumentParser(description="Benchmark acme-dns-tiny CSR loading.")
+    parser.add_argument("--csr-directory",
+                        help="directory of *.csr files to load (a corpus is generated otherwise)")
+    parser.add_argument("--count", type=int, default=20,
+                        help="number of CSR files to generate. Defaults to 20.")
+    parser.add_argument("--sans", type=int, default=100,
+                        help="number of DNS names of each generated CSR. Defaults to 100.")
+    parser.add_argument("--duration", type=float, default=2.0,
+                        help="number of seconds to run each loader. Defaults to 2.")
+    args = parser.parse_args(argv)
+
+    directory = args.csr_directory or tempfile.mkdtemp()
+    try:
+        if args.csr_directory:
+            csr_paths = sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                               if name.endswith(".csr"))
+        else:
+            csr_paths = generate_corpus(directory, args.count, args.sans)
+        for csr_path in csr_paths:
+            if load_csr_with_openssl(csr_path) != acme_dns_tiny.load_csr(csr_path):
+                print("Warning: loaders disagree on {0}".format(csr_path))
+        for name, loader in (("openssl", load_csr_with_openssl),
+                             ("in-process", acme_dns_tiny.load_csr)):
+            print("{0}: {1:.1f} CSR/s".format(name, bench_loader(loader, csr_paths,
+                                                                 args.duration)))
+    finally:
+        if args.csr_directory is None:
+            shutil.rmtree(directory)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main(sys.argv[1:])
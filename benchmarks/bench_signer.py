@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""Compare how many JWS signatures per second each signer backend produces"""
+import sys
+import os
+import argparse
+import subprocess
+import time
+from tempfile import NamedTemporaryFile
+import acme_dns_tiny
+
+# account key type -> openssl command and options generating it
+ACCOUNT_KEY_TYPES = {"rsa": ["genrsa", "2048"],
+                     "p256": ["ecparam", "-name", "prime256v1", "-genkey", "-noout"],
+                     "p384": ["ecparam", "-name", "secp384r1", "-genkey", "-noout"]}
+
+
+def generate_account_key(keypath, key_type="rsa"):
+    """Generate an account key file of the given type (rsa for 2048 bits, p256 or p384)."""
+    command, *options = ACCOUNT_KEY_TYPES[key_type]
+    subprocess.run(["openssl", command, "-out", keypath] + options, check=True,
+                   capture_output=True)
+
+
+def bench_signer(signer, duration):
+    """Sign a JWS like payload during duration seconds and return signatures per second."""
+    data = ("eyJhbGciOiJSUzI1NiIsImtpZCI6Imh0dHBzOi8vYWNtZS5leGFtcGxlL2FjY3QvMSJ9."
+            "eyJzdGF0dXMiOiJ2YWxpZCJ9").encode("utf8")
+    signatures = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        signer.sign(data)
+        signatures += 1
+    return signatures / (time.perf_counter() - start)
+
+
+def main(argv):
+    """Run the signer benchmark for each available backend."""
+    parser = argparse.ArgumentParser(description="Benchmark acme-dns-tiny signer backends.")
+    parser.add_argument("--account-key",
+                        help="account key to sign with (a key is generated otherwise)")
+    parser.add_argument("--key-type", choices=ACCOUNT_KEY_TYPES, default="rsa",
+                        help="type of the generated account key. Defaults to rsa (2048 bits).")
+    parser.add_argument("--duration", type=float, default=2.0,
+                        help="number of seconds to run each backend. Defaults to 2.")
+    args = parser.parse_args(argv)
+
+    keypath = args.account_key
+    if keypath is None:
+        with NamedTemporaryFile(delete=False) as account_key:
+            keypath = account_key.name
+        generate_account_key(keypath, args.key_type)
+    try:
+        for backend in ("openssl", "cryptography"):
+            try:
+                signer = acme_dns_tiny.get_signer(keypath, backend)
+            except ValueError as error:
+                print("{0}: skipped ({1})".format(backend, error))
+                continue
+            print("{0}: {1:.1f} signatures/s".format(backend, bench_signer(signer, args.duration)))
+    finally:
+        if args.account_key is None:
+            os.remove(keypath)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main(sys.argv[1:])
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""Measure the cold start of acme_dns_tiny in new Python processes, report them as JSON"""
+import sys
+import os
+import argparse
+import configparser
+import json
+import platform
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+from benchmarks.bench_suite import compare
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                      "acme_dns_tiny.py")
+
+
+def measure(command, repeat):
+    """Run command in a new process repeat times, return its runs per second (best and median
+    runs) and its duration."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=os.path.dirname(SCRIPT), check=False, capture_output=True)
+        times.append(time.perf_counter() - start)
+    return {"seconds": min(times), "median_seconds": statistics.median(times),
+            "ops_per_second": 1 / min(times),
+            "median_ops_per_second": 1 / statistics.median(times)}
+
+
+def write_configs(directory, count):
+    """Write count valid configuration files (sharing one account key and CSR) and one with
+    missing settings, return their paths."""
+    account_key, csr = os.path.join(directory, "account.key"), os.path.join(directory, "d.csr")
+    subprocess.run(["openssl", "req", "-new", "-newkey", "ec", "-pkeyopt",
+                    "ec_paramgen_curve:P-256", "-nodes", "-keyout", account_key,
+                    "-subj", "/CN=example.org", "-out", csr], check=True, capture_output=True)
+    configfiles = []
+    for index in range(count + 1):
+        config = configparser.ConfigParser()
+        config.read_dict({"acmednstiny": {"AccountKeyFile": account_key, "CSRFile": csr}})
+        if index < count:  # the last one misses its TSIG keyring
+            config.read_dict({"TSIGKeyring": {"KeyName": "key", "KeyValue": "c2VjcmV0",
+                                              "Algorithm": "hmac-sha256"}})
+        configfiles.append(os.path.join(directory, "config{0}.ini".format(index)))
+        with open(configfiles[-1], "w", encoding="utf-8") as config_file:
+            config.write(config_file)
+    return configfiles
+
+
+def main(argv):
+    """Run the startup benchmarks, write their JSON results and compare them to a baseline."""
+    parser = argparse.ArgumentParser(
+        description="Benchmark acme-dns-tiny cold start: import, help, configuration errors and "
+        "configuration checks, each in new Python processes.")
+    parser.add_argument("--configs", type=int, default=100,
+                        help="number of configuration files checked at once. Defaults to 100.")
+    parser.add_argument("--repeat", type=int, default=10,
+                        help="number of timed runs of each benchmark. Defaults to 10.")
+    parser.add_argument("--output", help="write the JSON results to this file, not stdout")
+    parser.add_argument("--baseline",
+                        help="JSON results of a previous run to compare with: exit with status 1 "
+                        "if a benchmark is slower than tolerated")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="tolerated slowdown against the baseline. Defaults to 0.2 (20%%).")
+    args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp()
+    try:
+        configfiles = write_configs(directory, args.configs)
+        commands = {
+            "python": [sys.executable, "-c", "pass"],
+            "import": [sys.executable, "-c", "import acme_dns_tiny"],
+            "help": [sys.executable, SCRIPT, "--help"],
+            "missing_settings": [sys.executable, SCRIPT, configfiles[-1]],
+            "check_config": [sys.executable, SCRIPT, "--check-config", configfiles[0]],
+            "check_configs": [sys.executable, SCRIPT, "--check-config"] + configfiles[:-1],
+        }
+        results = {"python": platform.python_version(), "configs": args.configs,
+                   "benchmarks": {name: measure(command, args.repeat)
+                                  for name, command in commands.items()}}
+    finally:
+        shutil.rmtree(directory)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            json.dump(results, output_file, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    if regressions:
+        sys.exit("Slower than the baseline: {0}".format(", ".join(regressions)))
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main(sys.argv[1:])
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""Measure the CPU bound hot paths of acme_dns_tiny in isolation, report them as JSON"""
+import sys
+import os
+import argparse
+import hashlib
+import json
+import platform
+import shutil
+import statistics
+import subprocess
+import tempfile
+import timeit
+import acme_dns_tiny
+from benchmarks.bench_csr import generate_corpus, load_csr_with_openssl
+from benchmarks.bench_signer import ACCOUNT_KEY_TYPES, generate_account_key
+
+# pylint: disable=protected-access
+
+
+def measure(function, repeat):
+    """Time function with timeit, return its calls per second (best and median runs)."""
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    times = timer.repeat(repeat, number)
+    return {"loops": number, "ops_per_second": number / min(times),
+            "median_ops_per_second": number / statistics.median(times)}
+
+
+def benchmarks(keypath, csr_path):
+    """Return the benchmarked callables by name, None when one can't run here."""
+    alg, jwk = acme_dns_tiny.load_account_key(keypath)
+    kid = "https://acme.example.org/acme/acct/123456789"
+    thumbprint = acme_dns_tiny._base64(hashlib.sha256(
+        json.dumps(jwk, sort_keys=True, separators=(",", ":")).encode("utf8")).digest())
+    payload = json.dumps({"identifiers": [{"type": "dns", "value": "www.example.org"}] * 4})
+    signing_input = "{0}.{1}".format(
+        acme_dns_tiny._jws_protected(alg, "https://acme.example.org/order", nonce="A" * 43,
+                                     kid=kid),
+        acme_dns_tiny._base64(payload.encode("utf8"))).encode("utf8")
+    signers = {}
+    for backend in ("openssl", "cryptography"):
+        try:
+            signers[backend] = acme_dns_tiny.get_signer(keypath, backend, alg).sign
+        except ValueError:
+            signers[backend] = None
+    return {
+        "base64": lambda: acme_dns_tiny._base64(payload.encode("utf8")),
+        "protected_header": lambda: acme_dns_tiny._jws_protected(
+            alg, "https://acme.example.org/order", nonce="A" * 43, kid=kid),
+        "sign_openssl": signers["openssl"] and (lambda: signers["openssl"](signing_input)),
+        "sign_cryptography": signers["cryptography"] and (
+            lambda: signers["cryptography"](signing_input)),
+        "load_csr": lambda: acme_dns_tiny.load_csr(csr_path),
+        "load_csr_openssl": lambda: load_csr_with_openssl(csr_path),
+        "load_account_key": lambda: acme_dns_tiny.load_account_key(keypath),
+        "txt_rrset": lambda: acme_dns_tiny._challenge_rrset(
+            "_acme-challenge.www.example.org.", 10,
+            "evaGxfADs6pSRb2LAv9IZf17Dt3juxGJ-PCt92wr-oA", thumbprint),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Return the names of benchmarks slower than the baseline by more than tolerance."""
+    regressions = []
+    for name, result in results["benchmarks"].items():
+        reference = baseline.get("benchmarks", {}).get(name)
+        if result is None or reference is None:
+            continue
+        ratio = result["ops_per_second"] / reference["ops_per_second"]
+        result["baseline_ratio"] = ratio
+        if ratio < 1 - tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv):
+    """Run the benchmark suite, write its JSON results and compare them to a baseline."""
+    parser = argparse.ArgumentParser(description="Benchmark acme-dns-tiny CPU hot paths.")
+    parser.add_argument("--account-key",
+                        help="account key to use (a key is generated otherwise)")
+    parser.add_argument("--key-type", choices=ACCOUNT_KEY_TYPES, default="rsa",
+                        help="type of the generated account key. Defaults to rsa (2048 bits).")
+    parser.add_argument("--sans", type=int, default=100,
+                        help="number of DNS names of the parsed CSR. Defaults to 100.")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="number of timed runs of each benchmark. Defaults to 5.")
+    parser.add_argument("--only", action="append",
+                        help="run only this benchmark (can be given many times)")
+    parser.add_argument("--output", help="write the JSON results to this file, not stdout")
+    parser.add_argument("--baseline",
+                        help="JSON results of a previous run to compare with: exit with status 1 "
+                        "if a benchmark is slower than tolerated")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="tolerated slowdown against the baseline. Defaults to 0.2 (20%%).")
+    args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp()
+    try:
+        keypath = args.account_key or os.path.join(directory, "account.key")
+        if args.account_key is None:
+            generate_account_key(keypath, args.key_type)
+        csr_path = generate_corpus(directory, 1, args.sans)[0]
+        results = {"python": platform.python_version(),
+                   "openssl": subprocess.run(["openssl", "version"], check=True,
+                                             capture_output=True, text=True).stdout.strip(),
+                   "cryptography": acme_dns_tiny.serialization is not None,
+                   "benchmarks": {}}
+        for name, function in benchmarks(keypath, csr_path).items():
+            if args.only and name not in args.only:
+                continue
+            results["benchmarks"][name] = function and measure(function, args.repeat)
+    finally:
+        shutil.rmtree(directory)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            json.dump(results, output_file, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    if regressions:
+        sys.exit("Slower than the baseline: {0}".format(", ".join(regressions)))
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main(sys.argv[1:])
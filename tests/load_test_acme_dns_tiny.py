@@ -0,0 +1,166 @@
+"""Load test acme-dns-tiny against the local ACME and DNS servers, without network access"""
+# pylint: disable=too-many-arguments
+import sys
+import os
+import argparse
+import asyncio
+import base64
+import configparser
+import json
+import logging
+import secrets
+import shutil
+import tempfile
+import time
+import acme_dns_tiny
+from benchmarks.bench_signer import ACCOUNT_KEY_TYPES, generate_account_key
+from tests.local_acme_server import LocalACMEServer
+from tests.local_dns_server import LocalDNSServer
+
+ZONE = "example.test"
+TSIG_KEY_NAME = "acme-dns-tiny-load-test"
+
+
+def start_servers(dns_address="127.0.0.1", nonce_reject_rate=0, validation_delay=0.0):
+    """Start the local DNS server (on port 53, as the client sends updates there) and the
+    local ACME server validating challenges with it, return them with the TSIG secret."""
+    tsig_secret = base64.b64encode(secrets.token_bytes(32)).decode("utf8")
+    dns_server = LocalDNSServer(ZONE + ".", TSIG_KEY_NAME, tsig_secret, address=dns_address,
+                                ttl=1).start()
+    acme_server = LocalACMEServer(dns_address, nonce_reject_rate=nonce_reject_rate,
+                                  validation_delay=validation_delay).start()
+    return dns_server, acme_server, tsig_secret
+
+
+def write_config(directory, acme_server, dns_server, tsig_secret, *, key_type="rsa",
+                 parallel_orders=4):
+    """Generate an account key and write a configuration file using the local servers."""
+    account_key = os.path.join(directory, "account.key")
+    generate_account_key(account_key, key_type)
+    config = configparser.ConfigParser()
+    config.read_dict({
+        "acmednstiny": {"AccountKeyFile": account_key, "ACMEDirectory": acme_server.directory_url,
+                        "Contacts": "mailto:load-test@{0}".format(ZONE),
+                        "MaxParallelOrders": parallel_orders, "PollInitialDelay": 0.1,
+                        "PollMaxDelay": 1},
+        "TSIGKeyring": {"KeyName": TSIG_KEY_NAME, "KeyValue": tsig_secret,
+                        "Algorithm": "hmac-sha256"},
+        "DNS": {"NameServer": dns_server.address, "TTL": 1}})
+    configfile = os.path.join(directory, "load_test.ini")
+    with open(configfile, "w", encoding="utf-8") as config_file:
+        config.write(config_file)
+    return configfile
+
+
+def write_csrs(directory, certificates, domains):
+    """Write the CSR of each certificate, with its domains in the local zone."""
+    csrfiles = []
+    for index in range(certificates):
+        _, csr_der = acme_dns_tiny.generate_csr(
+            ["host{0}.cert{1}.{2}".format(domain, index, ZONE) for domain in range(domains)],
+            "p256")
+        csrfiles.append(os.path.join(directory, "cert{0}.csr".format(index)))
+        with open(csrfiles[-1], "wb") as csr_file:
+            csr_file.write(csr_der)
+    return csrfiles
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of the values."""
+    ordered = sorted(values)
+    return ordered[max(0, -(-len(ordered) * percent // 100) - 1)] if ordered else None
+
+
+async def issue(configs, parallel_orders):
+    """Issue a certificate for each configuration as async_get_crts does, return the latency
+    of each order (or the exception which stopped it)."""
+    session = acme_dns_tiny.get_async_http_session(parallel_orders * 2)
+    shared = {}
+    semaphore = asyncio.Semaphore(parallel_orders or len(configs))
+
+    async def _issue(config):
+        async with semaphore:
+            start = time.perf_counter()
+            await acme_dns_tiny.async_get_crt(config, acme_dns_tiny.LOGGER, session, shared)
+            return time.perf_counter() - start
+    try:
+        return await asyncio.gather(*[_issue(config) for config in configs],
+                                    return_exceptions=True)
+    finally:
+        for client in shared.values():
+            await client.close()
+        await acme_dns_tiny._close_http_session(session)  # pylint: disable=protected-access
+
+
+def run_load_test(*, certificates=10, domains=2, parallel_orders=4, key_type="rsa",
+                  nonce_reject_rate=0, validation_delay=0.0, dns_address="127.0.0.1"):
+    """Issue certificates against local servers, return throughput and latency statistics."""
+    # pylint: disable=too-many-locals
+    dns_server, acme_server, tsig_secret = start_servers(dns_address, nonce_reject_rate,
+                                                         validation_delay)
+    directory = tempfile.mkdtemp()
+    try:
+        configfile = write_config(directory, acme_server, dns_server, tsig_secret,
+                                  key_type=key_type, parallel_orders=parallel_orders)
+        # pylint: disable=protected-access
+        configs = [acme_dns_tiny._read_config(configfile, csrfile)
+                   for csrfile in write_csrs(directory, certificates, domains)]
+        start = time.perf_counter()
+        results = asyncio.run(issue(configs, parallel_orders))
+        elapsed = time.perf_counter() - start
+    finally:
+        acme_server.stop()
+        dns_server.stop()
+        shutil.rmtree(directory)
+    latencies = [result for result in results if not isinstance(result, BaseException)]
+    return {
+        "certificates": certificates, "domains": domains, "parallel_orders": parallel_orders,
+        "key_type": key_type, "nonce_reject_rate": nonce_reject_rate,
+        "issued": len(latencies), "failed": [str(result) for result in results
+                                             if isinstance(result, BaseException)],
+        "elapsed_seconds": elapsed, "issuances_per_minute": len(latencies) * 60 / elapsed,
+        "latency_seconds": {"p50": percentile(latencies, 50), "p90": percentile(latencies, 90),
+                            "p99": percentile(latencies, 99),
+                            "max": max(latencies) if latencies else None},
+        "acme_requests": acme_server.requests, "dns_updates": dns_server.updates,
+        "dns_queries": dns_server.queries, "dns_connections": dns_server.connections}
+
+
+def main(argv):
+    """Run a load test and write its JSON report."""
+    parser = argparse.ArgumentParser(
+        description="Load test acme-dns-tiny with local ACME and DNS servers. The DNS server "
+        "listens on port 53, so it needs the right to bind it (e.g. run as root in a container).")
+    parser.add_argument("--certificates", type=int, default=10,
+                        help="number of certificates to issue. Defaults to 10.")
+    parser.add_argument("--domains", type=int, default=2,
+                        help="number of domains of each certificate. Defaults to 2.")
+    parser.add_argument("--parallel-orders", type=int, default=4,
+                        help="maximum number of orders at the same time (0 for all). "
+                        "Defaults to 4.")
+    parser.add_argument("--key-type", choices=ACCOUNT_KEY_TYPES, default="rsa",
+                        help="type of the account key. Defaults to rsa (2048 bits).")
+    parser.add_argument("--nonce-reject-rate", type=int, default=0,
+                        help="percentage of valid nonces rejected by the ACME server (every "
+                        "Nth nonce of each URL, at most 50). Defaults to 0.")
+    parser.add_argument("--validation-delay", type=float, default=0.0,
+                        help="seconds the ACME server waits before validating a challenge. "
+                        "Defaults to 0.")
+    parser.add_argument("--dns-address", default="127.0.0.1",
+                        help="address of the local DNS server. Defaults to 127.0.0.1.")
+    parser.add_argument("--verbose", action="store_true", help="show acme-dns-tiny logs")
+    args = parser.parse_args(argv)
+
+    acme_dns_tiny.LOGGER.setLevel(logging.INFO if args.verbose else logging.ERROR)
+    report = run_load_test(certificates=args.certificates, domains=args.domains,
+                           parallel_orders=args.parallel_orders, key_type=args.key_type,
+                           nonce_reject_rate=args.nonce_reject_rate,
+                           validation_delay=args.validation_delay, dns_address=args.dns_address)
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+    if report["failed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main(sys.argv[1:])
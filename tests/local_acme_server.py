@@ -0,0 +1,423 @@
+"""Tiny ACME server implementing the subset of RFC 8555 used by acme-dns-tiny, to run tests and
+load tests without a real certificate authority"""
+# pylint: disable=too-many-instance-attributes,too-many-arguments
+import base64
+import collections
+import datetime
+import hashlib
+import itertools
+import json
+import secrets
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import dns.resolver
+try:  # signs the certificates and checks the JWS signatures, the tests skip without it
+    from cryptography import x509
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec, padding, rsa, utils
+    from cryptography.x509.oid import NameOID
+except ImportError:
+    x509 = None
+
+
+def _b64decode(text):
+    """Decodes base64 url safe text without padding."""
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def _b64encode(data):
+    """Encodes base64 url safe text without padding."""
+    return base64.urlsafe_b64encode(data).decode("utf8").rstrip("=")
+
+
+def _jwk_thumbprint(jwk):
+    """Compute the RFC 7638 thumbprint of a public JWK."""
+    members = {"RSA": ("e", "kty", "n"), "EC": ("crv", "kty", "x", "y")}[jwk["kty"]]
+    canonical = json.dumps({k: jwk[k] for k in members}, sort_keys=True, separators=(",", ":"))
+    return _b64encode(hashlib.sha256(canonical.encode("utf8")).digest())
+
+
+def _verify_jws(jwk, alg, signing_input, signature):
+    """Verify a JWS signature with a public JWK, raise InvalidSignature on failure."""
+    if jwk["kty"] == "RSA":
+        public_key = rsa.RSAPublicNumbers(int.from_bytes(_b64decode(jwk["e"]), "big"),
+                                          int.from_bytes(_b64decode(jwk["n"]), "big")
+                                          ).public_key()
+        public_key.verify(signature, signing_input, padding.PKCS1v15(), hashes.SHA256())
+        return
+    curve, hash_algorithm = {"ES256": (ec.SECP256R1(), hashes.SHA256()),
+                             "ES384": (ec.SECP384R1(), hashes.SHA384())}[alg]
+    public_key = ec.EllipticCurvePublicNumbers(int.from_bytes(_b64decode(jwk["x"]), "big"),
+                                               int.from_bytes(_b64decode(jwk["y"]), "big"),
+                                               curve).public_key()
+    size = len(signature) // 2
+    public_key.verify(utils.encode_dss_signature(int.from_bytes(signature[:size], "big"),
+                                                 int.from_bytes(signature[size:], "big")),
+                      signing_input, ec.ECDSA(hash_algorithm))
+
+
+class AcmeError(Exception):
+    """ACME problem document to return to the client."""
+
+    def __init__(self, status, error_type, detail):
+        super().__init__(detail)
+        self.status = status
+        self.problem = {"type": "urn:ietf:params:acme:error:" + error_type, "detail": detail}
+
+
+class LocalACMEServer:
+    """Serve an ACME directory over plain HTTP and validate dns-01 challenges."""
+
+    def __init__(self, dns_nameserver, *, address="127.0.0.1", port=0, nonce_reject_rate=0,
+                 validation_delay=0.0, certificate_lifetime=90):
+        self.address = address
+        self.port = port
+        self.dns_nameserver = dns_nameserver
+        self.nonce_reject_rate = nonce_reject_rate
+        self.validation_delay = validation_delay
+        self.certificate_lifetime = certificate_lifetime
+        self.lock = threading.Lock()
+        self.counter = itertools.count(1)
+        self.nonces = set()
+        self.nonce_counts = collections.Counter()  # JWS URL -> number of valid nonces seen
+        self.accounts = {}  # account URL -> account object with its "jwk"
+        self.orders = {}
+        self.authorizations = {}
+        self.challenges = {}  # challenge URL -> (authorization URL, challenge object)
+        self.certificates = {}
+        self.requests = 0  # requests served, not counting the ones rejected for their nonce
+        self.posts = collections.Counter()  # path -> signed requests served, counted the same
+        self.renewal_info = {}  # ARI certificate identifier -> certificate expiration date
+        self.replaced = []  # certificate identifiers given by new orders as "replaces", once
+        # Knobs to exercise the client: days added to suggested renewal windows, status given to
+        # challenges while they are validated, number of certificate downloads to fail
+        self.renewal_shift = 0
+        self.challenge_status = "processing"
+        self.fail_certificates = 0
+        self._server = None
+        self.ca_key = ec.generate_private_key(ec.SECP256R1())
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "acme-dns-tiny local CA")])
+        now = datetime.datetime.now(datetime.timezone.utc)
+        self.ca_certificate = (x509.CertificateBuilder()
+                               .subject_name(name).issuer_name(name)
+                               .public_key(self.ca_key.public_key())
+                               .serial_number(x509.random_serial_number())
+                               .not_valid_before(now)
+                               .not_valid_after(now + datetime.timedelta(3650))
+                               .add_extension(x509.BasicConstraints(ca=True, path_length=None),
+                                              critical=True)
+                               .sign(self.ca_key, hashes.SHA256()))
+
+    @property
+    def url(self):
+        """Base URL of the server."""
+        return "http://{0}:{1}".format(self.address, self.port)
+
+    @property
+    def directory_url(self):
+        """ACME directory URL."""
+        return self.url + "/directory"
+
+    def _new_url(self, kind):
+        """Create the URL of a new resource."""
+        return "{0}/{1}/{2}".format(self.url, kind, next(self.counter))
+
+    def new_nonce(self):
+        """Create a new valid nonce."""
+        nonce = secrets.token_urlsafe(16)
+        with self.lock:
+            self.nonces.add(nonce)
+        return nonce
+
+    def directory(self):
+        """The ACME directory object."""
+        return {"newNonce": self.url + "/new-nonce", "newAccount": self.url + "/new-account",
+                "newOrder": self.url + "/new-order", "revokeCert": self.url + "/revoke-cert",
+                "keyChange": self.url + "/key-change", "renewalInfo": self.url + "/renewal-info",
+                "meta": {"termsOfService": self.url + "/terms"}}
+
+    def _check_jws(self, url, jose, expect_jwk=False, check_nonce=True):
+        """Check a flattened JWS and return its protected header and decoded payload."""
+        protected = json.loads(_b64decode(jose["protected"]))
+        if check_nonce:
+            with self.lock:
+                nonce_valid = protected.get("nonce") in self.nonces
+                self.nonces.discard(protected.get("nonce"))
+                # reject every Nth valid nonce of each URL: a client retrying a rejected request
+                # is only rejected again after N - 1 other requests to its URL
+                if nonce_valid:
+                    self.nonce_counts[url] += 1
+                rejected = nonce_valid and self.nonce_reject_rate > 0 and self.nonce_counts[
+                    url] % max(2, round(100 / self.nonce_reject_rate)) == 0
+            if not nonce_valid or rejected:
+                raise AcmeError(400, "badNonce", "JWS has an invalid anti-replay nonce")
+        if protected.get("url") != url:
+            raise AcmeError(401, "unauthorized", "JWS url header does not match request URL")
+        if expect_jwk or "jwk" in protected:
+            if "jwk" not in protected:
+                raise AcmeError(400, "malformed", "jwk header is required")
+            jwk, account = protected["jwk"], None
+        else:
+            account = self.accounts.get(protected.get("kid"))
+            if account is None:
+                raise AcmeError(400, "accountDoesNotExist", "unknown account kid")
+            if account["status"] != "valid":
+                raise AcmeError(401, "unauthorized", "account is not valid")
+            jwk = account["jwk"]
+        try:
+            _verify_jws(jwk, protected["alg"],
+                        "{0}.{1}".format(jose["protected"], jose["payload"]).encode("utf8"),
+                        _b64decode(jose["signature"]))
+        except (InvalidSignature, KeyError, ValueError) as error:
+            raise AcmeError(400, "malformed", "JWS signature is invalid") from error
+        payload = json.loads(_b64decode(jose["payload"])) if jose["payload"] else ""
+        return protected, payload, account
+
+    def _validate(self, authz_url, challenge_url):
+        """Check the dns-01 challenge TXT record like a real CA would do."""
+        time.sleep(self.validation_delay)
+        with self.lock:
+            authorization = self.authorizations[authz_url]
+            _, challenge = self.challenges[challenge_url]
+            account = self.accounts[authorization["account"]]
+        expected = _b64encode(hashlib.sha256("{0}.{1}".format(
+            challenge["token"], _jwk_thumbprint(account["jwk"])).encode("utf8")).digest())
+        resolver = dns.resolver.Resolver(configure=False)
+        resolver.nameservers = [self.dns_nameserver]
+        resolver.cache = None
+        try:
+            values = [rdata.to_text().strip('"') for rdata in resolver.resolve(
+                "_acme-challenge.{0}.".format(authorization["identifier"]["value"].lstrip("*.")),
+                "TXT", lifetime=5)]
+        except dns.exception.DNSException:
+            values = []
+        with self.lock:
+            valid = expected in values
+            challenge["status"] = authorization["status"] = "valid" if valid else "invalid"
+            if valid:
+                challenge["validated"] = datetime.datetime.now(datetime.timezone.utc).isoformat()
+            else:
+                challenge["error"] = {"type": "urn:ietf:params:acme:error:incorrectResponse",
+                                      "detail": "TXT record not found: {0}".format(values)}
+            for order in self.orders.values():
+                if authz_url in order["authorizations"] and order["status"] == "pending":
+                    statuses = {self.authorizations[a]["status"] for a in order["authorizations"]}
+                    if "invalid" in statuses:
+                        order["status"] = "invalid"
+                    elif statuses == {"valid"}:
+                        order["status"] = "ready"
+
+    def _issue(self, order, csr_der):
+        """Issue the certificate of an order from its DER encoded CSR."""
+        csr = x509.load_der_x509_csr(csr_der)
+        try:
+            names = set(csr.extensions.get_extension_for_class(
+                x509.SubjectAlternativeName).value.get_values_for_type(x509.DNSName))
+        except x509.ExtensionNotFound:
+            names = set()
+        names |= {attribute.value for attribute
+                  in csr.subject.get_attributes_for_oid(NameOID.COMMON_NAME)}
+        if names != {identifier["value"] for identifier in order["identifiers"]}:
+            raise AcmeError(400, "badCSR", "CSR identifiers do not match the order")
+        now = datetime.datetime.now(datetime.timezone.utc)
+        certificate = (x509.CertificateBuilder()
+                       .subject_name(x509.Name([]))
+                       .issuer_name(self.ca_certificate.subject)
+                       .public_key(csr.public_key())
+                       .serial_number(x509.random_serial_number())
+                       .not_valid_before(now)
+                       .not_valid_after(now + datetime.timedelta(self.certificate_lifetime))
+                       .add_extension(x509.AuthorityKeyIdentifier.from_issuer_public_key(
+                           self.ca_key.public_key()), critical=False)
+                       .add_extension(x509.SubjectAlternativeName(
+                           [x509.DNSName(name) for name in sorted(names)]), critical=True)
+                       .sign(self.ca_key, hashes.SHA256()))
+        serial = certificate.serial_number
+        cert_id = "{0}.{1}".format(_b64encode(x509.AuthorityKeyIdentifier.from_issuer_public_key(
+            self.ca_key.public_key()).key_identifier), _b64encode(
+                serial.to_bytes((serial.bit_length() + 8) // 8, "big")))
+        self.renewal_info[cert_id] = now + datetime.timedelta(self.certificate_lifetime)
+        return "".join(pem.public_bytes(serialization.Encoding.PEM).decode("utf8")
+                       for pem in (certificate, self.ca_certificate))
+
+    # pylint: disable=too-many-branches,too-many-statements,too-many-return-statements
+    # pylint: disable=too-many-locals
+    def handle_post(self, url, jose):
+        """Handle a signed POST request and return status, headers and body."""
+        if url == self.url + "/new-account":
+            protected, payload, _ = self._check_jws(url, jose, expect_jwk=True)
+            with self.lock:
+                for account_url, account in self.accounts.items():
+                    if account["jwk"] == protected["jwk"] and account["status"] == "valid":
+                        return 200, {"Location": account_url}, self._public(account)
+                if payload.get("onlyReturnExisting"):
+                    raise AcmeError(400, "accountDoesNotExist", "no account for this key")
+                account_url = self._new_url("account")
+                self.accounts[account_url] = {"status": "valid", "jwk": protected["jwk"],
+                                              "contact": payload.get("contact", []),
+                                              "orders": account_url + "/orders"}
+                return 201, {"Location": account_url}, self._public(self.accounts[account_url])
+        if url == self.url + "/key-change":
+            _, payload, account = self._check_jws(url, jose)
+            inner, inner_payload, _ = self._check_jws(url, payload, expect_jwk=True,
+                                                      check_nonce=False)
+            if inner_payload.get("oldKey") != account["jwk"]:
+                raise AcmeError(400, "malformed", "oldKey does not match the account key")
+            account["jwk"] = inner["jwk"]
+            return 200, {}, self._public(account)
+        if url == self.url + "/new-order":
+            protected, payload, _ = self._check_jws(url, jose)
+            with self.lock:
+                order_url = self._new_url("order")
+                if payload.get("replaces") in self.replaced:
+                    raise AcmeError(409, "alreadyReplaced", "certificate already replaced")
+                if "replaces" in payload:
+                    self.replaced.append(payload["replaces"])
+                order = {"status": "pending", "identifiers": payload["identifiers"],
+                         "authorizations": [], "finalize": order_url + "/finalize",
+                         "account": protected["kid"]}
+                for identifier in payload["identifiers"]:
+                    authz_url = self._new_url("authz")
+                    challenge_url = self._new_url("challenge")
+                    challenge = {"type": "dns-01", "url": challenge_url, "status": "pending",
+                                 "token": secrets.token_urlsafe(32)}
+                    self.authorizations[authz_url] = {
+                        "status": "pending", "identifier": {
+                            "type": "dns", "value": identifier["value"].lstrip("*.")},
+                        "wildcard": identifier["value"].startswith("*."),
+                        "challenges": [challenge], "account": protected["kid"]}
+                    self.challenges[challenge_url] = (authz_url, challenge)
+                    order["authorizations"].append(authz_url)
+                self.orders[order_url] = order
+                return 201, {"Location": order_url}, self._public(order)
+        protected, payload, account = self._check_jws(url, jose)
+        with self.lock:
+            if url in self.accounts:
+                if url != protected["kid"]:
+                    raise AcmeError(401, "unauthorized", "not your account")
+                if payload:
+                    for field in ("contact", "status"):
+                        if field in payload:
+                            account[field] = payload[field]
+                return 200, {}, self._public(account)
+            if url in self.authorizations:
+                return 200, {}, self._public(self.authorizations[url])
+            if url in self.challenges:
+                authz_url, challenge = self.challenges[url]
+                if payload == {} and challenge["status"] == "pending":
+                    challenge["status"] = self.challenge_status
+                    threading.Thread(target=self._validate, args=(authz_url, url),
+                                     daemon=True).start()
+                return 200, {"Link": '<{0}>;rel="up"'.format(authz_url)}, dict(challenge)
+            if url in self.orders:
+                order = self.orders[url]
+                headers = {"Retry-After": "1"} if order["status"] == "processing" else {}
+                return 200, headers, self._public(order)
+            if url in self.certificates and self.fail_certificates > 0:
+                self.fail_certificates -= 1
+                raise AcmeError(500, "serverInternal", "try again later")
+            if url in self.certificates:
+                return 200, {"Content-Type": "application/pem-certificate-chain"}, \
+                    self.certificates[url]
+            order_url = url[:-len("/finalize")]
+            if url.endswith("/finalize") and order_url in self.orders:
+                order = self.orders[order_url]
+                if order["status"] != "ready":
+                    raise AcmeError(403, "orderNotReady", "order is " + order["status"])
+                certificate_url = self._new_url("certificate")
+                self.certificates[certificate_url] = self._issue(order, _b64decode(payload["csr"]))
+                order["status"] = "valid"
+                order["certificate"] = certificate_url
+                return 200, {"Location": order_url}, self._public(order)
+        raise AcmeError(404, "malformed", "unknown resource " + url)
+
+    def suggested_window(self, cert_id):
+        """Renewal information of a certificate: the window starts 30 days before expiration."""
+        end = self.renewal_info.get(cert_id)
+        if end is None:
+            return None
+        end = end + datetime.timedelta(self.renewal_shift)
+        # the start has nanoseconds, as some servers give them
+        return {"suggestedWindow": {
+            "start": (end - datetime.timedelta(30)).strftime("%Y-%m-%dT%H:%M:%S.123456789Z"),
+            "end": (end - datetime.timedelta(28)).strftime("%Y-%m-%dT%H:%M:%SZ")}}
+
+    @staticmethod
+    def _public(resource):
+        """Return a resource without private server informations."""
+        return {k: v for k, v in resource.items() if k not in ("account", "jwk")}
+
+    def start(self):
+        """Start serving in a background thread."""
+        server = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):  # pylint: disable=arguments-differ
+                pass
+
+            def _reply(self, status, headers, body):
+                data = body if isinstance(body, bytes) else (
+                    body.encode("utf8") if isinstance(body, str) else json.dumps(body).encode())
+                self.send_response(status)
+                self.send_header("Replay-Nonce", server.new_nonce())
+                self.send_header("Cache-Control", "no-store")
+                if isinstance(body, (dict, list)) and "Content-Type" not in headers:
+                    self.send_header("Content-Type", "application/json")
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                if self.command != "HEAD":
+                    self.wfile.write(data)
+
+            def do_HEAD(self):  # pylint: disable=invalid-name
+                """Handle HEAD newNonce requests."""
+                self.do_GET()
+
+            def do_GET(self):  # pylint: disable=invalid-name
+                """Handle directory and newNonce requests."""
+                with server.lock:
+                    server.requests += 1
+                if self.path == "/directory":
+                    self._reply(200, {}, server.directory())
+                elif self.path.startswith("/renewal-info/"):
+                    info = server.suggested_window(self.path[len("/renewal-info/"):])
+                    self._reply(200 if info else 404, {"Retry-After": "21600"},
+                                info or {"type": "urn:ietf:params:acme:error:malformed"})
+                elif self.path == "/new-nonce":
+                    self._reply(204 if self.command == "GET" else 200, {}, b"")
+                else:
+                    self._reply(404, {}, {"type": "about:blank", "detail": "not found"})
+
+            def do_POST(self):  # pylint: disable=invalid-name
+                """Handle signed ACME requests."""
+                with server.lock:
+                    server.requests += 1
+                    server.posts[self.path] += 1
+                jose = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                try:
+                    self._reply(*server.handle_post(server.url + self.path, jose))
+                except AcmeError as error:
+                    if error.problem["type"].endswith(":badNonce"):
+                        with server.lock:  # count the retried request only once
+                            server.requests -= 1
+                            server.posts[self.path] -= 1
+                    self._reply(error.status, {"Content-Type": "application/problem+json"},
+                                error.problem)
+
+        self._server = ThreadingHTTPServer((self.address, self.port), _Handler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        """Stop serving."""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
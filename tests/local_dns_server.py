@@ -0,0 +1,156 @@
+"""Tiny authoritative DNS server accepting TSIG signed dynamic updates (RFC 2136), to run
+tests and load tests without a real DNS server"""
+import socket
+import socketserver
+import struct
+import threading
+import dns.flags
+import dns.message
+import dns.name
+import dns.opcode
+import dns.rcode
+import dns.rdataclass
+import dns.rdatatype
+import dns.rrset
+import dns.tsig
+import dns.tsigkeyring
+# pylint: disable=too-many-instance-attributes,too-many-arguments
+
+
+class LocalDNSServer:
+    """Serve one zone on UDP and TCP, answer queries and apply TSIG signed updates."""
+
+    def __init__(self, zone, keyname, keyvalue, *, address="127.0.0.1", port=53, ttl=10):
+        self.zone = dns.name.from_text(zone)
+        self.keyring = dns.tsigkeyring.from_text({keyname: keyvalue})
+        self.address = address
+        self.port = port
+        self.lock = threading.Lock()
+        self.updates = 0
+        self.queries = 0
+        self.connections = 0  # TCP connections accepted
+        self.refuse_updates = False
+        nameserver = dns.name.from_text("ns1", self.zone)
+        self.records = {
+            (self.zone, dns.rdatatype.SOA): dns.rrset.from_text(
+                self.zone, ttl, "IN", "SOA",
+                "{0} hostmaster.{1} 1 3600 600 86400 {2}".format(nameserver, self.zone, ttl)),
+            (self.zone, dns.rdatatype.NS): dns.rrset.from_text(
+                self.zone, ttl, "IN", "NS", nameserver.to_text()),
+            (nameserver, dns.rdatatype.A): dns.rrset.from_text(
+                nameserver, ttl, "IN", "A", address),
+        }
+        self._servers = []
+
+    def txt_values(self, name):
+        """Return the TXT values currently served for the given name."""
+        with self.lock:
+            rrset = self.records.get((dns.name.from_text(name), dns.rdatatype.TXT))
+            return [rdata.to_text() for rdata in rrset] if rrset else []
+
+    def _apply_update(self, update):
+        """Apply the update section of an UPDATE message to the served records."""
+        with self.lock:
+            self.updates += 1
+            for rrset in update.update:
+                key = (rrset.name, rrset.rdtype)
+                # dnspython gives deletions with the zone class, and their class in "deleting"
+                deleting = getattr(rrset, "deleting", None)
+                if deleting is None and rrset.rdclass != dns.rdataclass.IN:
+                    deleting = rrset.rdclass
+                if deleting is None:
+                    current = self.records.setdefault(key, dns.rrset.RRset(
+                        rrset.name, dns.rdataclass.IN, rrset.rdtype))
+                    current.update_ttl(rrset.ttl)
+                    for rdata in rrset:
+                        current.add(rdata)
+                elif deleting == dns.rdataclass.ANY:
+                    for known in [k for k in self.records if k[0] == rrset.name]:
+                        if rrset.rdtype in (dns.rdatatype.ANY, known[1]):
+                            del self.records[known]
+                elif deleting == dns.rdataclass.NONE and key in self.records:
+                    for rdata in rrset:
+                        self.records[key].discard(rdata)
+                    if not self.records[key]:
+                        del self.records[key]
+
+    def _answer(self, query):
+        """Build the response of a standard query."""
+        response = dns.message.make_response(query)
+        response.flags |= dns.flags.AA
+        question = query.question[0]
+        with self.lock:
+            self.queries += 1
+            if not question.name.is_subdomain(self.zone):
+                response.set_rcode(dns.rcode.REFUSED)
+                return response
+            rrset = self.records.get((question.name, question.rdtype))
+            if rrset is not None:
+                response.answer.append(rrset)
+            elif not any(name == question.name for name, _ in self.records):
+                response.set_rcode(dns.rcode.NXDOMAIN)
+            if rrset is None:
+                response.authority.append(self.records[(self.zone, dns.rdatatype.SOA)])
+        return response
+
+    def handle(self, wire):
+        """Handle a wire formatted DNS message and return the wire formatted response."""
+        try:
+            message = dns.message.from_wire(wire, keyring=self.keyring)
+        except (dns.tsig.PeerError, dns.message.UnknownTSIGKey):
+            message = dns.message.from_wire(wire, ignore_trailing=True, keyring=False)
+            response = dns.message.make_response(message)
+            response.set_rcode(dns.rcode.NOTAUTH)
+            return response.to_wire()
+        if message.opcode() == dns.opcode.UPDATE:
+            response = dns.message.make_response(message)
+            if not message.had_tsig or message.zone[0].name != self.zone or self.refuse_updates:
+                response.set_rcode(dns.rcode.REFUSED)
+            else:
+                self._apply_update(message)
+            return response.to_wire()
+        return self._answer(message).to_wire()
+
+    def start(self):
+        """Start serving in background threads."""
+        server = self
+
+        class _UDPHandler(socketserver.BaseRequestHandler):
+            def handle(self):
+                data, sock = self.request
+                sock.sendto(server.handle(data), self.client_address)
+
+        class _TCPHandler(socketserver.BaseRequestHandler):
+            def handle(self):
+                with server.lock:
+                    server.connections += 1
+                while True:  # a client can send several messages on one connection
+                    header = self.request.recv(2)
+                    if len(header) < 2:
+                        return
+                    length = struct.unpack("!H", header)[0]
+                    data = b""
+                    while len(data) < length:
+                        chunk = self.request.recv(length - len(data))
+                        if not chunk:
+                            return
+                        data += chunk
+                    wire = server.handle(data)
+                    self.request.sendall(struct.pack("!H", len(wire)) + wire)
+
+        family = socket.AF_INET6 if ":" in self.address else socket.AF_INET
+        for base_class, handler in ((socketserver.ThreadingUDPServer, _UDPHandler),
+                                    (socketserver.ThreadingTCPServer, _TCPHandler)):
+            server_class = type("_Server", (base_class,), {
+                "address_family": family, "allow_reuse_address": True, "daemon_threads": True})
+            instance = server_class((self.address, self.port), handler)
+            threading.Thread(target=instance.serve_forever, daemon=True).start()
+            self._servers.append(instance)
+        return self
+
+    def stop(self):
+        """Stop serving."""
+        for instance in self._servers:
+            instance.shutdown()
+            instance.server_close()
+        self._servers = []
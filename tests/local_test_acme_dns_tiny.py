@@ -0,0 +1,296 @@
+"""End to end tests of acme_dns_tiny with the local ACME and DNS servers"""
+import unittest
+import asyncio
+import gc
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import warnings
+from contextlib import redirect_stdout
+from io import StringIO
+import dns.rrset
+import acme_dns_tiny
+from tests import local_acme_server
+from tests.load_test_acme_dns_tiny import (start_servers, write_config, write_csrs,
+                                           run_load_test)
+
+
+class TestLocalACMEDNSTiny(unittest.TestCase):
+    "Tests for acme_dns_tiny.main() and get_crts() without network access"
+
+    @classmethod
+    def setUpClass(cls):
+        if local_acme_server.x509 is None:
+            raise unittest.SkipTest("cryptography module is not installed")
+        try:
+            cls.dns_server, cls.acme_server, tsig_secret = start_servers(nonce_reject_rate=20)
+        except PermissionError as error:
+            raise unittest.SkipTest("Unable to listen on DNS port 53: {0}".format(error))
+        cls.directory = tempfile.mkdtemp()
+        cls.configfile = write_config(cls.directory, cls.acme_server, cls.dns_server,
+                                      tsig_secret, key_type="p256")
+        super(TestLocalACMEDNSTiny, cls).setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.acme_server.stop()
+        cls.dns_server.stop()
+        shutil.rmtree(cls.directory)
+        super(TestLocalACMEDNSTiny, cls).tearDownClass()
+
+    def test_success_certificate_chain_on_stdout(self):
+        """ Certificate chain is written on stdout, despite rejected nonces """
+        csrfile = write_csrs(self.directory, 1, 2)[0]
+        output = StringIO()
+        with redirect_stdout(output):
+            acme_dns_tiny.main(["--csr", csrfile, self.configfile, "--quiet"])
+        self.assertEqual(output.getvalue().count("-----BEGIN CERTIFICATE-----"), 2)
+        self.assertEqual(self.dns_server.txt_values("_acme-challenge.host0.cert0.example.test"),
+                         [])
+
+    def test_success_batch_of_certificates(self):
+        """ Batch mode writes a certificate chain next to each CSR file, sending all its DNS
+        updates on one connection """
+        csr_directory = os.path.join(self.directory, "batch")
+        os.mkdir(csr_directory)
+        write_csrs(csr_directory, 3, 2)
+        updates, connections = self.dns_server.updates, self.dns_server.connections
+        acme_dns_tiny.main(["--csr-directory", csr_directory, self.configfile, "--quiet"])
+        self.assertEqual(sorted(name for name in os.listdir(csr_directory)
+                                if name.endswith(".crt")),
+                         ["cert0.crt", "cert1.crt", "cert2.crt"])
+        self.assertGreaterEqual(self.dns_server.updates - updates, 6)
+        self.assertEqual(self.dns_server.connections - connections, 1)
+
+    def test_success_challenge_pending_during_validation(self):
+        """ Challenges left pending by the ACME server while it validates them are polled until
+        they are valid """
+        config = acme_dns_tiny._read_config(  # pylint: disable=protected-access
+            self.configfile, write_csrs(self.directory, 1, 2)[0])
+        self.acme_server.challenge_status = "pending"
+        try:
+            self.assertEqual(acme_dns_tiny.get_crt(config).count("-----BEGIN CERTIFICATE-----"),
+                             2)
+        finally:
+            self.acme_server.challenge_status = "processing"
+
+    def test_success_get_crt_with_session_closes_its_client(self):
+        """ Orders given only an HTTP session close their DNS connections, not the session """
+        config = acme_dns_tiny._read_config(  # pylint: disable=protected-access
+            self.configfile, write_csrs(self.directory, 1, 1)[0])
+        session = acme_dns_tiny.get_http_session()
+        connections = self.dns_server.connections
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always", ResourceWarning)
+            for _ in range(2):
+                acme_dns_tiny.get_crt(config, session=session)
+            gc.collect()
+        session.close()
+        self.assertEqual(self.dns_server.connections - connections, 2)
+        self.assertEqual([warning for warning in caught
+                          if issubclass(warning.category, ResourceWarning)], [])
+
+    def test_success_client_reused_for_orders_and_account_operations(self):
+        """ One client orders many certificates, then rolls over and deactivates its account """
+        config = acme_dns_tiny._read_config(  # pylint: disable=protected-access
+            self.configfile, write_csrs(self.directory, 1, 1)[0])
+        keys = [os.path.join(self.directory, name) for name in ("client.key", "rollover.key")]
+        for key in keys:
+            subprocess.run(["openssl", "ecparam", "-name", "prime256v1", "-genkey", "-noout",
+                            "-out", key], check=True, capture_output=True)
+        config.set("acmednstiny", "AccountKeyFile", keys[0])
+
+        async def _run():
+            chains, requests = [], [self.acme_server.requests]
+            async with acme_dns_tiny.AcmeClient(config) as client, \
+                    acme_dns_tiny.AcmeClient(config) as new_client:
+                for order_client in (client, client, new_client):
+                    chains.append(await order_client.get_crt())
+                    requests.append(self.acme_server.requests)
+                account = client.kid
+                await client.rollover(keys[1])
+                await client.deactivate()
+            return chains, [after - before for before, after in zip(requests, requests[1:])], \
+                account
+        chains, requests, account = asyncio.run(_run())
+        self.assertEqual([chain.count("-----BEGIN CERTIFICATE-----") for chain in chains],
+                         [2, 2, 2])
+        # a warm client reuses its directory, nonces and account identifier, a new one can't
+        self.assertLess(requests[1], requests[2])
+        self.assertEqual(self.acme_server.accounts[account]["status"], "deactivated")
+
+    def test_success_dns_update_with_unreachable_server_address(self):
+        """ DNS updates don't wait for the timeout of an unreachable main server address """
+        config = acme_dns_tiny._read_config(  # pylint: disable=protected-access
+            self.configfile, write_csrs(self.directory, 1, 1)[0])
+        name = "_acme-challenge.staggered.example.test."
+
+        async def _run():
+            async with acme_dns_tiny.AcmeClient(config) as client:
+                _, zone_cache = await client.dns_helpers()
+                # an unroutable IPv6 address comes first, as ZoneCache orders them
+                zone_cache._servers["example.test."] = {  # pylint: disable=protected-access
+                    "ips": ["100::1", self.dns_server.address], "expires": time.time() + 60}
+                start = time.perf_counter()
+                await client.update_dns([dns.rrset.from_text(name, 1, "IN", "TXT", '"value"')],
+                                        "add")
+                return time.perf_counter() - start
+        self.assertLess(asyncio.run(_run()), 5)
+        self.assertEqual(self.dns_server.txt_values(name), ['"value"'])
+
+    def test_success_order_with_unreachable_server_address(self):
+        """ Challenges are checked on the reachable address of each authoritative server """
+        config = acme_dns_tiny._read_config(  # pylint: disable=protected-access
+            self.configfile, write_csrs(self.directory, 1, 1)[0])
+
+        async def _run():
+            async with acme_dns_tiny.AcmeClient(config) as client:
+                _, zone_cache = await client.dns_helpers()
+                ips = ["100::1", self.dns_server.address]  # unroutable IPv6 address first
+                zone_cache._servers["example.test."] = {  # pylint: disable=protected-access
+                    "ips": ips, "hosts": {"ns1.example.test.": ips},
+                    "expires": time.time() + 60}
+                start = time.perf_counter()
+                chain = await client.get_crt()
+                return chain, time.perf_counter() - start
+        chain, elapsed = asyncio.run(_run())
+        self.assertEqual(chain.count("-----BEGIN CERTIFICATE-----"), 2)
+        self.assertLess(elapsed, 5)
+
+    def test_success_challenges_checked_with_resolver_without_reachable_server(self):
+        """ Challenges are checked with the resolver when no authoritative server answers, and
+        never taken as verified when the resolver doesn't serve them either """
+        config = acme_dns_tiny._read_config(  # pylint: disable=protected-access
+            self.configfile, write_csrs(self.directory, 1, 1)[0])
+        config.set("DNS", "Timeout", "1")
+        name = "_acme-challenge.missing.example.test."
+        missing = {"domain": "missing.example.test", "dnsrr_domain": name, "keydigest64": "x",
+                   "dnsrr_set": dns.rrset.from_text(name, 1, "IN", "TXT", '"x"')}
+
+        async def _run(pendings=None):
+            async with acme_dns_tiny.AcmeClient(config) as client:
+                _, zone_cache = await client.dns_helpers()
+                # updates reach the local server, which can't be queried at its only address
+                zone_cache._servers["example.test."] = {  # pylint: disable=protected-access
+                    "ips": [self.dns_server.address], "hosts": {"ns1.example.test.": ["100::1"]},
+                    "expires": time.time() + 60}
+                if pendings:
+                    return await client._self_test_challenges(  # pylint: disable=protected-access
+                        pendings, 4)
+                return await client.get_crt()
+        self.assertEqual(asyncio.run(_run()).count("-----BEGIN CERTIFICATE-----"), 2)
+        self.assertRaisesRegex(ValueError, r"Error checking challenge, value not found: x",
+                               asyncio.run, _run({"missing": missing}))
+
+    def test_failure_dns_update_of_one_zone_cleans_the_other_ones(self):
+        """ When a zone can't be updated, resources added to the other zones are deleted """
+        csrfile = os.path.join(self.directory, "two_zones.csr")
+        with open(csrfile, "wb") as csr_file:
+            csr_file.write(acme_dns_tiny.generate_csr(
+                ["host.zones.example.test", "host.other.test"], "p256")[1])
+        config = acme_dns_tiny._read_config(  # pylint: disable=protected-access
+            self.configfile, csrfile)
+        updates = self.dns_server.updates
+
+        async def _run():
+            async with acme_dns_tiny.AcmeClient(config) as client:
+                _, zone_cache = await client.dns_helpers()
+                # pylint: disable=protected-access
+                zone_cache._zones["_acme-challenge.host.other.test."] = {
+                    "zone": "other.test.", "expires": time.time() + 60}
+                # the local server refuses updates of a zone it doesn't serve
+                zone_cache._servers["other.test."] = {
+                    "ips": [self.dns_server.address], "expires": time.time() + 60}
+                await client.get_crt()
+        self.assertRaisesRegex(RuntimeError, r"Unable to add DNS resource to "
+                               r"_acme-challenge.host.other.test.", asyncio.run, _run())
+        self.assertEqual(self.dns_server.updates - updates, 2)
+        self.assertEqual(
+            self.dns_server.txt_values("_acme-challenge.host.zones.example.test"), [])
+
+    def test_success_order_resumed_from_journal(self):
+        """ A run failing part-way is resumed by the next one, without a new order nor new DNS
+        updates """
+        config = acme_dns_tiny._read_config(  # pylint: disable=protected-access
+            self.configfile, write_csrs(self.directory, 1, 2)[0])
+        config.set("acmednstiny", "StateDirectory", os.path.join(self.directory, "journal"))
+        self.acme_server.fail_certificates = 1
+        self.assertRaisesRegex(ValueError, r"Finalizing order 500", acme_dns_tiny.get_crt,
+                               config)
+        orders, updates = len(self.acme_server.orders), self.dns_server.updates
+        self.assertEqual(acme_dns_tiny.get_crt(config).count("-----BEGIN CERTIFICATE-----"), 2)
+        self.assertEqual((len(self.acme_server.orders), self.dns_server.updates),
+                         (orders, updates))
+
+    def test_success_account_cached_in_state_directory(self):
+        """ A warm run uses the cached account identifier, registered again once it's unknown
+        to the ACME server """
+        config = acme_dns_tiny._read_config(  # pylint: disable=protected-access
+            self.configfile, write_csrs(self.directory, 1, 1)[0])
+        config.set("acmednstiny", "AccountKeyFile", os.path.join(self.directory, "cached.key"))
+        config.set("acmednstiny", "StateDirectory", os.path.join(self.directory, "accounts"))
+        subprocess.run(["openssl", "ecparam", "-name", "prime256v1", "-genkey", "-noout",
+                        "-out", config["acmednstiny"]["AccountKeyFile"]],
+                       check=True, capture_output=True)
+        new_account = self.acme_server.posts["/new-account"]
+        acme_dns_tiny.get_crt(config)
+        self.assertEqual(self.acme_server.posts["/new-account"] - new_account, 1)
+        jwk = acme_dns_tiny.load_account_key(config["acmednstiny"]["AccountKeyFile"])[1]
+        kid = [url for url, account in self.acme_server.accounts.items()
+               if account["jwk"] == jwk][0]
+        acme_dns_tiny.get_crt(config)
+        self.assertEqual(self.acme_server.posts["/new-account"] - new_account, 1)
+        del self.acme_server.accounts[kid]
+        acme_dns_tiny.get_crt(config)
+        self.assertEqual(self.acme_server.posts["/new-account"] - new_account, 2)
+
+    def test_success_renewal_suggested_by_acme_server(self):
+        """ Renewal mode skips certificates not due according to the ACME server, replaces the
+        due ones, and orders again when a certificate has already been replaced """
+        csr_directory = os.path.join(self.directory, "renewals")
+        os.mkdir(csr_directory)
+        write_csrs(csr_directory, 1, 1)
+        crtfile = os.path.join(csr_directory, "cert0.crt")
+        arguments = ["--csr-directory", csr_directory, self.configfile, "--quiet"]
+        acme_dns_tiny.main(arguments)
+        with open(crtfile, encoding="utf-8") as certificate_file:
+            certificate = certificate_file.read()
+        cert_id = acme_dns_tiny._certificate_validity(  # pylint: disable=protected-access
+            certificate)[2]
+        orders = len(self.acme_server.orders)
+        acme_dns_tiny.main(["--renew"] + arguments)
+        with open(crtfile, encoding="utf-8") as certificate_file:
+            self.assertEqual(certificate_file.read(), certificate)
+        self.assertEqual(len(self.acme_server.orders), orders)
+        self.acme_server.renewal_shift = -90
+        try:
+            acme_dns_tiny.main(["--renew"] + arguments)
+            self.assertEqual(self.acme_server.replaced[-1], cert_id)
+            self.assertEqual(len(self.acme_server.orders), orders + 1)
+            with open(crtfile, "w", encoding="utf-8") as certificate_file:
+                certificate_file.write(certificate)
+            acme_dns_tiny.main(["--renew"] + arguments)
+        finally:
+            self.acme_server.renewal_shift = 0
+        self.assertEqual(self.acme_server.replaced.count(cert_id), 1)
+        self.assertEqual(len(self.acme_server.orders), orders + 2)
+        with open(crtfile, encoding="utf-8") as certificate_file:
+            self.assertNotEqual(certificate_file.read(), certificate)
+
+    def test_success_load_test_report(self):
+        """ Load test issues every certificate and reports latency percentiles """
+        self.acme_server.stop()
+        self.dns_server.stop()
+        try:
+            report = run_load_test(certificates=4, domains=2, parallel_orders=2)
+        finally:
+            self.dns_server.start()
+            self.acme_server.start()
+        self.assertEqual((report["issued"], report["failed"]), (4, []))
+        self.assertLessEqual(report["latency_seconds"]["p50"], report["latency_seconds"]["max"])
+
+
+if __name__ == "__main__":  # pragma: no cover
+    unittest.main()
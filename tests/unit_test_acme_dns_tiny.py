@@ -1,8 +1,13 @@
 """Unit tests for the acme_dns_tiny script"""
 import unittest
+import asyncio
 import sys
 import os
+import subprocess
+import tempfile
+import time
 import configparser
+from unittest import mock
 import dns.version
 import acme_dns_tiny
 from tests.config_factory import generate_acme_dns_tiny_unit_test_config
@@ -47,6 +52,208 @@ class TestACMEDNSTiny(unittest.TestCase):
                                acme_dns_tiny.main, [self.configs['missing_tsigkeyring'],
                                                     "--verbose"])
 
+    def test_success_signer_backends_match(self):
+        """ In-process and openssl signatures of the same data are identical """
+        if acme_dns_tiny.serialization is None:
+            self.skipTest("cryptography module is not installed")
+        parser = configparser.ConfigParser()
+        parser.read(self.configs['missing_tsigkeyring'])
+        keypath = parser["acmednstiny"]["AccountKeyFile"]
+        data = b"protected.payload"
+        self.assertEqual(acme_dns_tiny.get_signer(keypath, "cryptography").sign(data),
+                         acme_dns_tiny.get_signer(keypath, "openssl").sign(data))
+
+    def test_success_ec_account_key(self):
+        """ EC account keys give their JWK and fixed size JWS signatures with both backends """
+        with tempfile.NamedTemporaryFile() as keyfile:
+            subprocess.run(["openssl", "ecparam", "-name", "secp384r1", "-genkey", "-noout",
+                            "-out", keyfile.name], check=True, capture_output=True)
+            alg, jwk = acme_dns_tiny.load_account_key(keyfile.name)
+            self.assertEqual(alg, "ES384")
+            self.assertEqual((jwk["kty"], jwk["crv"]), ("EC", "P-384"))
+            backends = ["openssl"] + ([] if acme_dns_tiny.serialization is None
+                                      else ["cryptography"])
+            for backend in backends:
+                self.assertEqual(len(acme_dns_tiny.get_signer(keyfile.name, backend)
+                                     .sign(b"protected.payload")), 96)
+
+    def test_success_account_key_loaded_without_openssl(self):
+        """ Account keys give the same JWK in-process as with openssl, without running it """
+        if acme_dns_tiny.serialization is None:
+            self.skipTest("cryptography module is not installed")
+        for key_options in (["genrsa", "2048"], ["ecparam", "-name", "prime256v1", "-genkey",
+                                                 "-noout"]):
+            with tempfile.NamedTemporaryFile() as keyfile:
+                subprocess.run(["openssl", key_options[0], "-out", keyfile.name, *key_options[1:]],
+                               check=True, capture_output=True)
+                with mock.patch.object(acme_dns_tiny, "_openssl") as openssl:
+                    key = acme_dns_tiny.load_account_key(keyfile.name)
+                openssl.assert_not_called()
+                with mock.patch.object(acme_dns_tiny, "serialization", None):
+                    self.assertEqual(acme_dns_tiny.load_account_key(keyfile.name), key)
+
+    def test_failure_compressed_ec_account_key(self):
+        """ EC account keys with a compressed public point are refused by openssl """
+        with tempfile.NamedTemporaryFile() as keyfile:
+            key = subprocess.run(["openssl", "ecparam", "-name", "prime256v1", "-genkey",
+                                  "-noout"], check=True, capture_output=True).stdout
+            subprocess.run(["openssl", "ec", "-conv_form", "compressed", "-out", keyfile.name],
+                           input=key, check=True, capture_output=True)
+            with mock.patch.object(acme_dns_tiny, "serialization", None):
+                self.assertRaisesRegex(ValueError, r"should be an uncompressed point",
+                                       acme_dns_tiny.load_account_key, keyfile.name)
+
+    def test_failure_unknown_signer_backend(self):
+        """ Signer backend has to be known """
+        self.assertRaisesRegex(ValueError, r"Unknown signer backend",
+                               acme_dns_tiny.get_signer, "account.key", "unknown")
+
+    def test_success_httpx_trusts_requests_ca_bundle(self):
+        """ Asynchronous HTTP sessions trust the CA bundle given to requests """
+        ca_bundle = os.path.join(os.path.dirname(__file__), "pebble.pem")
+        # pylint: disable=protected-access
+        with mock.patch.dict(os.environ, {"REQUESTS_CA_BUNDLE": ca_bundle}):
+            self.assertEqual(len(acme_dns_tiny._ssl_context().get_ca_certs()), 1)
+        with mock.patch.dict(os.environ, {"REQUESTS_CA_BUNDLE": "", "CURL_CA_BUNDLE": ""}):
+            self.assertIs(acme_dns_tiny._ssl_context(), True)
+
+    def test_success_httpx_session_without_requests(self):
+        """ Asynchronous HTTP sessions are created and closed when requests isn't installed """
+        if acme_dns_tiny.httpx is None:
+            self.skipTest("httpx module is not installed")
+        subprocess.run([sys.executable, "-c", "import sys, asyncio\n"
+                        "sys.modules['requests'] = None\nimport acme_dns_tiny\n"
+                        "asyncio.run(acme_dns_tiny._close_http_session("
+                        "acme_dns_tiny.get_async_http_session()))"], check=True)
+
+    def test_failure_get_crt_with_asynchronous_session(self):
+        """ Blocking orders refuse httpx sessions, bound to the event loop of a single call """
+        if acme_dns_tiny.httpx is None:
+            self.skipTest("httpx module is not installed")
+        session = acme_dns_tiny.httpx.AsyncClient()
+        self.assertRaisesRegex(ValueError, r"can't reuse an httpx.AsyncClient session",
+                               acme_dns_tiny.get_crt, None, session=session)
+
+    def test_success_nonce_pool_gives_latest_harvested_nonce(self):
+        """ Nonce pool hands out harvested nonces, most recent first, dropping the oldest """
+        class _Response:  # pylint: disable=too-few-public-methods
+            def __init__(self, nonce):
+                self.headers = {"Replay-Nonce": nonce} if nonce else {}
+
+        nonces = acme_dns_tiny.NoncePool(None, "https://acme.invalid/new-nonce", size=2)
+        for nonce in ("first", "second", None, "third"):
+            nonces.harvest(_Response(nonce))
+        self.assertEqual(asyncio.run(nonces.get()), "third")
+        self.assertEqual(asyncio.run(nonces.get()), "second")
+
+    def test_success_cache_expiration_honours_http_headers(self):
+        """ Cached ACME directory expires according to HTTP caching headers """
+        self.assertEqual(acme_dns_tiny._cache_expiration(  # pylint: disable=protected-access
+            {"Cache-Control": "public, max-age=0, no-cache"}), 0)
+        # pylint: disable=protected-access
+        self.assertEqual(acme_dns_tiny._cache_expiration({}), 0)
+        self.assertGreater(acme_dns_tiny._cache_expiration(
+            {"Cache-Control": "max-age=3600"}), time.time() + 3500)
+
+    def test_failure_poller_deadline(self):
+        """ Poller follows Retry-After delays and gives up after its timeout """
+        class _Response:  # pylint: disable=too-few-public-methods
+            headers = {"Retry-After": "120"}
+
+        poller = acme_dns_tiny.Poller("order", timeout=60)
+        self.assertEqual(poller.retry_after(_Response()), 120)
+        self.assertRaisesRegex(ValueError, r"Timeout while waiting for order after 1 polls",
+                               poller.next_delay, _Response())
+
+    def test_success_renewal_schedule_without_renewal_information(self):
+        """ Renewal time is stable and inside the last third of the certificate validity """
+        # pylint: disable=protected-access
+        certificate = subprocess.run(
+            ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-keyout", os.devnull,
+             "-days", "90", "-subj", "/CN=acme-dns-tiny.test"],
+            check=True, capture_output=True, text=True).stdout
+        not_before, not_after, cert_id = acme_dns_tiny._certificate_validity(certificate)
+        self.assertAlmostEqual(not_after - not_before, 90 * 86400)
+        self.assertRegex(cert_id, r"^[A-Za-z0-9_-]+\.[A-Za-z0-9_-]+$")
+        renewal = asyncio.run(acme_dns_tiny._renewal_schedule(certificate, {}, None, {}))
+        self.assertIsNone(renewal["replaces"])
+        self.assertTrue(not_before + 60 * 86400 <= renewal["time"] <= not_before + 67.5 * 86400)
+        self.assertEqual(renewal, asyncio.run(
+            acme_dns_tiny._renewal_schedule(certificate, {}, None, {})))
+
+    def test_success_metrics_report(self):
+        """ Metrics count the calls of the current run and export them for Prometheus """
+        metrics = acme_dns_tiny.Metrics()
+
+        async def _run():
+            acme_dns_tiny._METRICS.set(metrics)  # pylint: disable=protected-access
+            await asyncio.to_thread(acme_dns_tiny._openssl,  # pylint: disable=protected-access
+                                    "version", [])
+        asyncio.run(_run())
+        metrics.count("issued")
+        report = metrics.report()
+        self.assertEqual(report["calls"]["subprocess"]["count"], 1)
+        self.assertEqual(report["certificates"], {"issued": 1, "not_due": 0, "failed": 0})
+        self.assertIn('acme_dns_tiny_last_run_calls{call="subprocess"} 1\n', metrics.prometheus())
+
+    def test_success_load_csr_with_common_name_and_san(self):
+        """ CSR loader finds the CN and SAN DNS names and keeps the DER encoding """
+        with tempfile.TemporaryDirectory() as directory:
+            csr_path = os.path.join(directory, "domain.csr")
+            subprocess.run(["openssl", "req", "-new", "-newkey", "rsa:2048", "-nodes", "-keyout",
+                            os.devnull, "-subj", "/O=Example, Inc/CN=example.org", "-addext",
+                            "subjectAltName=DNS:www.example.org,IP:192.0.2.1,DNS:*.example.org",
+                            "-out", csr_path], check=True, capture_output=True)
+            csr_der, domains = acme_dns_tiny.load_csr(csr_path)
+            self.assertEqual(domains, {"example.org", "www.example.org", "*.example.org"})
+            self.assertEqual(csr_der, subprocess.run(
+                ["openssl", "req", "-in", csr_path, "-outform", "DER"],
+                check=True, capture_output=True).stdout)
+
+    def test_success_generate_csr_for_domains(self):
+        """ Generated CSR holds the domains and the private key is written only for its owner """
+        key_pem, csr_der = acme_dns_tiny.generate_csr(["example.org", "www.example.org"], "p256")
+        with tempfile.TemporaryDirectory() as directory:
+            csr_path = os.path.join(directory, "domain.csr")
+            with open(csr_path, "wb") as csr_file:
+                csr_file.write(csr_der)
+            self.assertEqual(acme_dns_tiny.load_csr(csr_path)[1],
+                             {"example.org", "www.example.org"})
+            key_path = os.path.join(directory, "domain.key")
+            acme_dns_tiny.write_private_key(key_path, key_pem)
+            self.assertEqual(os.stat(key_path).st_mode & 0o777, 0o600)
+            self.assertEqual(sorted(os.listdir(directory)), ["domain.csr", "domain.key"])
+
+    def test_success_check_config_without_network_modules(self):
+        """ Configuration checks find invalid settings without loading HTTP and DNS modules """
+        with tempfile.TemporaryDirectory() as directory:
+            subprocess.run(["openssl", "req", "-new", "-newkey", "ec", "-pkeyopt",
+                            "ec_paramgen_curve:P-256", "-nodes", "-keyout",
+                            os.path.join(directory, "account.key"), "-subj", "/CN=example.org",
+                            "-out", os.path.join(directory, "domain.csr")],
+                           check=True, capture_output=True)
+            for name, algorithm in (("valid.ini", "hmac-sha256"), ("invalid.ini", "hmac-foo")):
+                config = configparser.ConfigParser()
+                config.read_dict({
+                    "acmednstiny": {"AccountKeyFile": os.path.join(directory, "account.key"),
+                                    "CSRFile": os.path.join(directory, "domain.csr")},
+                    "TSIGKeyring": {"KeyName": "key", "KeyValue": "c2VjcmV0",
+                                    "Algorithm": algorithm}})
+                with open(os.path.join(directory, name), "w", encoding="utf-8") as config_file:
+                    config.write(config_file)
+            check = subprocess.run(
+                [sys.executable, "-c", "import sys, acme_dns_tiny\n"
+                 "try:\n    acme_dns_tiny.main(sys.argv[1:])\n"
+                 "finally:\n    print(sorted(set(sys.modules) & {'requests', 'httpx', "
+                 "'dns.asyncquery', 'dns.asyncresolver'}))",
+                 "--check-config", os.path.join(directory, "valid.ini"),
+                 os.path.join(directory, "invalid.ini")], capture_output=True, text=True,
+                check=False)
+            self.assertIn("valid.ini is valid, for domains: example.org", check.stderr)
+            self.assertIn("invalid.ini is invalid: The TSIG keyring is invalid", check.stderr)
+            self.assertIn("1 of 2 configurations are invalid.", check.stderr)
+            self.assertEqual(check.stdout, "[]\n")
+
 
 if __name__ == "__main__":  # pragma: no cover
     unittest.main()
@@ -1,120 +1,27 @@
 #!/usr/bin/env python3
 """Tiny script to deactivate account on an ACME server."""
 import sys
+import os
 import argparse
-import subprocess
-import json
-import base64
-import binascii
-import re
-import copy
+import asyncio
 import logging
-import requests
+try:
+    import acme_dns_tiny
+except ImportError:  # run from the tools directory
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import acme_dns_tiny
 
 LOGGER = logging.getLogger("acme_account_deactivate")
 LOGGER.addHandler(logging.StreamHandler())
 
 
-def _b64(text):
-    """Encodes text as base64 as specified in ACME RFC."""
-    return base64.urlsafe_b64encode(text).decode("utf8").rstrip("=")
-
-
-def _openssl(command, options, communicate=None):
-    """Run openssl command line and raise IOError on non-zero return."""
-    with subprocess.Popen(["openssl", command] + options, stdin=subprocess.PIPE,
-                          stdout=subprocess.PIPE, stderr=subprocess.PIPE) as openssl:
-        out, err = openssl.communicate(communicate)
-        if openssl.returncode != 0:
-            raise IOError("OpenSSL Error: {0}".format(err))
-        return out
-
-
-# pylint: disable=too-many-statements
 def account_deactivate(accountkeypath, acme_directory, timeout, log=LOGGER):
     """Deactivate an ACME account."""
-
-    def _send_signed_request(url, payload):
-        """Sends signed requests to ACME server."""
-        nonlocal nonce
-        if payload == "":  # on POST-as-GET, final payload has to be just empty string
-            payload64 = ""
-        else:
-            payload64 = _b64(json.dumps(payload).encode("utf8"))
-        protected = copy.deepcopy(private_acme_signature)
-        protected["nonce"] = nonce or requests.get(
-            acme_config["newNonce"], headers=adt_headers, timeout=timeout).headers['Replay-Nonce']
-        del nonce
-        protected["url"] = url
-        if url == acme_config["newAccount"]:
-            if "kid" in protected:
-                del protected["kid"]
-        else:
-            del protected["jwk"]
-        protected64 = _b64(json.dumps(protected).encode("utf8"))
-        signature = _openssl("dgst", ["-sha256", "-sign", accountkeypath],
-                             "{0}.{1}".format(protected64, payload64).encode("utf8"))
-        jose = {
-            "protected": protected64, "payload": payload64, "signature": _b64(signature)
-        }
-        jose_headers = {'Content-Type': 'application/jose+json'} | adt_headers
-        try:
-            response = requests.post(url, json=jose, headers=jose_headers, timeout=timeout)
-        except requests.exceptions.RequestException as error:
-            response = error.response
-        if response:
-            nonce = response.headers['Replay-Nonce']
-            try:
-                return response, response.json()
-            except ValueError:  # if body is empty or not JSON formatted
-                return response, json.loads("{}")
-        else:
-            raise RuntimeError("Unable to get response from ACME server.")
-
-    # main code
-    adt_headers = {'User-Agent': 'acme-dns-tiny/4.0'}
-    nonce = None
-
-    log.info("Fetch informations from the ACME directory.")
-    acme_config = requests.get(acme_directory, headers=adt_headers, timeout=timeout).json()
-
-    log.info("Get private signature from account key.")
-    accountkey = _openssl("rsa", ["-in", accountkeypath, "-noout", "-text"])
-    signature_search = re.search(r"modulus:\s+?00:([a-f0-9\:\s]+?)\r?\npublicExponent: ([0-9]+)",
-                                 accountkey.decode("utf8"), re.MULTILINE)
-    if signature_search is None:
-        raise ValueError("Unable to retrieve private signature.")
-    pub_hex, pub_exp = signature_search.groups()
-    pub_exp = "{0:x}".format(int(pub_exp))
-    pub_exp = "0{0}".format(pub_exp) if len(pub_exp) % 2 else pub_exp
-    # That signature is used to authenticate with the ACME server, it needs to be safely kept
-    private_acme_signature = {
-        "alg": "RS256",
-        "jwk": {
-            "e": _b64(binascii.unhexlify(pub_exp.encode("utf-8"))),
-            "kty": "RSA",
-            "n": _b64(binascii.unhexlify(re.sub(r"(\s|:)", "", pub_hex).encode("utf-8"))),
-        },
-    }
-
-    log.info("Ask to the ACME server the account identifier to complete the private signature.")
-    http_response, result = _send_signed_request(acme_config["newAccount"],
-                                                 {"onlyReturnExisting": True})
-    if http_response.status_code == 200:
-        private_acme_signature["kid"] = http_response.headers['Location']
-    else:
-        raise ValueError("Error looking or account URL: {0} {1}"
-                         .format(http_response.status_code, result))
-
-    log.info("Deactivating the account.")
-    http_response, result = _send_signed_request(private_acme_signature["kid"],
-                                                 {"status": "deactivated"})
-
-    if http_response.status_code == 200:
-        log.info("The account has been deactivated.")
-    else:
-        raise ValueError("Error while deactivating the account key: {0} {1}"
-                         .format(http_response.status_code, result))
+    async def _deactivate():
+        config = acme_dns_tiny.account_config(accountkeypath, acme_directory, timeout)
+        async with acme_dns_tiny.AcmeClient(config, log) as client:
+            await client.deactivate()
+    asyncio.run(_deactivate())
 
 
 def main(argv):
@@ -128,7 +35,7 @@ You should revoke all TLS certificates linked to the account *before* using this
 as the server won't accept any further request when account is deactivated.
 
 It will need to access the ACME private account key, so PLEASE READ THROUGH IT!
-It's around 150 lines, so it won't take long.
+It's a thin wrapper over the ACME client of acme_dns_tiny.py, which you should read too.
 
 Example: deactivate account.key from staging Let's Encrypt:
   python3 acme_account_deactivate.py --account-key account.key --acme-directory \
@@ -144,10 +51,18 @@ https://acme-staging-v02.api.letsencrypt.org/directory"""
     parser.add_argument("--timeout", type=int, default=10,
                         help="""Number of seconds to wait before ACME requests time out.
                         Set it to 0 to wait indefinitely. Defaults to 10.""")
+    parser.add_argument("--profile",
+                        help="profile the script with cProfile and write its statistics to this \
+file (read them with python3 -m pstats), then log its number of openssl runs and HTTP requests")
     args = parser.parse_args(argv)
 
     LOGGER.setLevel(args.quiet or logging.INFO)
-    account_deactivate(args.account_key, args.acme_directory, args.timeout or None, log=LOGGER)
+    if args.profile:
+        acme_dns_tiny.run_profiled(args.profile, LOGGER, account_deactivate, args.account_key,
+                                   args.acme_directory, args.timeout or None)
+    else:
+        account_deactivate(args.account_key, args.acme_directory, args.timeout or None,
+                           log=LOGGER)
 
 
 if __name__ == "__main__":  # pragma: no cover